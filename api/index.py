@@ -3,7 +3,13 @@ FastAPI webhook handler for Telegram bot.
 Main entry point for Kepler CFO.
 """
 import os
+import re
+import asyncio
 import logging
+import orjson
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from typing import Dict, Any, Optional
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
@@ -14,15 +20,22 @@ from core.brain import (
     parse_schedule_reminder,
     classify_financial_action,
     generate_cfo_response,
+    stream_cfo_response,
+    stream_spending_advice,
     generate_spending_advice,
     generate_mentorship_advice,
+    stream_mentorship_advice,
     generate_transaction_query_response,
-    generate_operational_response
+    generate_operational_response,
+    get_openai_client,
+    close_openai_client
 )
 from core.db import (
     insert_transaction, 
-    update_budget_spent, 
+    register_expense,
     get_budget_status,
+    get_budgets_bulk,
+    BUDGET_CATEGORIES,
     get_all_debts,
     update_debt_balance,
     get_patrimony,
@@ -30,7 +43,8 @@ from core.db import (
     update_patrimony_end_of_month,
     reset_all_budgets,
     get_complete_financial_state,
-    save_conversation_message,
+    save_conversation_message_bg,
+    drain_background_tasks,
     get_conversation_history,
     get_transactions,
     save_thought_reminder,
@@ -40,8 +54,11 @@ from core.db import (
     mark_reminder_sent,
     ensure_default_reminders_for_chat,
     save_custom_schedule_reminder,
+    get_async_client,
+    close_async_client,
+    count_schedule_reminders,
 )
-from core.telegram import send_message
+from core.telegram import send_message, stream_message, get_telegram_client, close_telegram_client
 
 load_dotenv()
 
@@ -49,7 +66,59 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Kepler CFO Telegram Bot")
+KEPLER_TZ = os.getenv("KEPLER_TZ", "America/Bogota")
+# La zona horaria se resuelve una vez al importar (UTC si no se puede cargar)
+try:
+    KEPLER_TZINFO = ZoneInfo(KEPLER_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    KEPLER_TZINFO = timezone.utc
+CRON_SECRET = os.getenv("CRON_SECRET")
+
+# Recordatorios enviados a la vez por el cron (Telegram limita ~30 msg/s por bot)
+MAX_CONCURRENT_REMINDERS = 20
+
+# Nombres legibles de las categorías de presupuesto (reporte financiero)
+CATEGORY_NAMES = {
+    "fixed_survival": "Gastos Fijos/Sobrevivencia",
+    "debt_offensive": "Pagos Extra Deuda",
+    "kepler_growth": "Inversión Negocio",
+    "networking_life": "Vida Social/Networking",
+    "stupid_expenses": "Gastos Innecesarios"
+}
+
+def _iso_to_display(value: str, with_time: bool = False) -> str:
+    """
+    '2026-01-31T14:05:00+00:00' -> '31/01/2026' (o '31/01/2026 14:05').
+    Los campos ISO-8601 tienen ancho fijo: se recorta el string en vez de parsear un datetime.
+    Devuelve '' si no parece una fecha ISO.
+    """
+    if len(value) < 10 or value[4] != "-" or value[7] != "-":
+        return ""
+    display = f"{value[8:10]}/{value[5:7]}/{value[:4]}"
+    if with_time and len(value) >= 16:
+        display += f" {value[11:16]}"
+    return display
+
+
+# Mensajes que casi seguro son de mentoría: se arranca el mentor en paralelo al router
+_MENTOR_HINT_RE = re.compile(r"\b(perdido|consejo|estancado|desmotivado|coach|miedo)\b")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Crea los clientes al arrancar el worker para que el primer mensaje no pague su construcción
+    get_async_client()
+    get_openai_client()
+    get_telegram_client()
+    yield
+    # Termina las escrituras pendientes y cierra los pools (Supabase, OpenAI y Telegram) al apagar el worker
+    await drain_background_tasks()
+    await close_async_client()
+    await close_openai_client()
+    await close_telegram_client()
+
+
+app = FastAPI(title="Kepler CFO Telegram Bot", lifespan=lifespan)
 
 
 def parse_date_query(text: str) -> Optional[str]:
@@ -57,9 +126,6 @@ def parse_date_query(text: str) -> Optional[str]:
     Parse Spanish date queries like "hoy", "ayer", "hace dos días", "viernes pasado", "hace dos meses"
     Returns date string in format 'YYYY-MM-DD', 'today', 'yesterday', or None
     """
-    from datetime import datetime, timedelta
-    import re
-    
     text_lower = text.lower().strip()
     now = datetime.now()
     
@@ -231,28 +297,14 @@ async def cron_reminders_status():
     Debug: muestra hora actual, timezone, y cuántos recordatorios hay.
     No envía nada, solo información.
     """
-    from datetime import datetime, timezone
     try:
-        tz_name = os.getenv("KEPLER_TZ", "America/Bogota")
-        try:
-            import pytz
-            tz = pytz.timezone(tz_name)
-        except Exception:
-            tz = timezone.utc
-        now = datetime.now(tz)
+        tz_name = KEPLER_TZ
+        now = datetime.now(KEPLER_TZINFO)
         current_date = now.date().isoformat()
         current_weekday = now.weekday()
 
         # Contar recordatorios en BD (sin filtrar por hora)
-        headers = {
-            "apikey": os.getenv("SUPABASE_KEY"),
-            "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-        }
-        import httpx
-        url = f"{os.getenv('SUPABASE_URL').rstrip('/')}/rest/v1/schedule_reminders"
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, params={"select": "id,chat_id,hour,minute,days_of_week"}, headers=headers)
-            total_in_db = len(r.json()) if r.status_code == 200 and isinstance(r.json(), list) else 0
+        total_in_db = await count_schedule_reminders()
 
         pending = await get_pending_schedule_reminders(
             current_hour=now.hour,
@@ -282,22 +334,14 @@ async def cron_reminders(request: Request):
     Envía recordatorios según el horario del Plan Kepler.
     Protegido por CRON_SECRET en header o query.
     """
-    from datetime import datetime
     try:
-        cron_secret = os.getenv("CRON_SECRET")
+        cron_secret = CRON_SECRET
         if cron_secret:
             auth = request.headers.get("Authorization") or request.query_params.get("secret", "")
             if auth != f"Bearer {cron_secret}" and auth != cron_secret:
                 raise HTTPException(status_code=403, detail="Unauthorized")
         
-        tz_name = os.getenv("KEPLER_TZ", "America/Bogota")
-        try:
-            import pytz
-            tz = pytz.timezone(tz_name)
-        except Exception:
-            from datetime import timezone
-            tz = timezone.utc
-        now = datetime.now(tz)
+        now = datetime.now(KEPLER_TZINFO)
         current_date = now.date().isoformat()
         current_weekday = now.weekday()  # 0=Monday, 6=Sunday
         
@@ -308,16 +352,26 @@ async def cron_reminders(request: Request):
             current_date=current_date
         )
         
-        sent = 0
-        for rem in pending:
-            chat_id = rem.get("chat_id")
-            message = rem.get("message", "")
-            rem_id = rem.get("id")
-            is_one_time = rem.get("specific_date") is not None
-            if chat_id and message:
-                await send_message(chat_id=int(chat_id), text=message)
-                await mark_reminder_sent(rem_id, current_date, is_one_time=is_one_time)
-                sent += 1
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REMINDERS)
+
+        async def _handle(rem):
+            # send_message no lanza (devuelve False), así que marcar no depende del envío
+            async with semaphore:
+                await asyncio.gather(
+                    send_message(chat_id=int(rem["chat_id"]), text=rem["message"]),
+                    mark_reminder_sent(
+                        rem.get("id"), current_date, is_one_time=rem.get("specific_date") is not None
+                    ),
+                )
+
+        results = await asyncio.gather(
+            *[_handle(rem) for rem in pending if rem.get("chat_id") and rem.get("message")],
+            return_exceptions=True,
+        )
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error(f"Cron reminder failed: {error}")
+        sent = sum(1 for r in results if not isinstance(r, Exception))
         
         return JSONResponse({"status": "ok", "sent": sent, "total": len(pending)})
     except HTTPException:
@@ -347,7 +401,7 @@ async def webhook(request: Request):
             raise HTTPException(status_code=403, detail="Unauthorized")
         
         # Parse Telegram update
-        update = await request.json()
+        update = orjson.loads(await request.body())
         logger.info(f"Received update: {update}")
         
         # Extract message
@@ -374,6 +428,10 @@ async def webhook(request: Request):
                 "response": "Por favor, envía un mensaje de texto. Ejemplo: 'Gasté 50000 en comida'"
             })
         
+        # Step 2 (en paralelo): Analyze intent (Router Layer) - Now returns FINANCE, MENTORSHIP, or REMINDER
+        logger.info(f"Analyzing intent for message: {user_text}")
+        intent_task = asyncio.create_task(analyze_intent(user_text))
+        
         # Step 1: Get conversation history (más mensajes para mentoría y operativo)
         conversation_history = []
         try:
@@ -382,12 +440,21 @@ async def webhook(request: Request):
         except Exception as e:
             logger.warning(f"Could not retrieve conversation history: {str(e)}")
         
-        # Step 2: Analyze intent (Router Layer) - Now returns FINANCE, MENTORSHIP, or REMINDER
-        logger.info(f"Analyzing intent for message: {user_text}")
-        intent = analyze_intent(user_text)
+        # Mentoría especulativa: si el router no confirma MENTORSHIP, se cancela
+        mentor_task = None
+        if _MENTOR_HINT_RE.search(user_text.lower()):
+            mentor_task = asyncio.create_task(
+                generate_mentorship_advice(user_text, conversation_history=conversation_history)
+            )
+        
+        intent = await intent_task
         logger.info(f"Intent: {intent}")
+        if mentor_task and intent != "MENTORSHIP":
+            mentor_task.cancel()
         
         response_text = ""
+        # True cuando la respuesta ya se envió a Telegram por streaming
+        response_sent = False
         
         # Step 3: Route to appropriate layer
         if intent == "REMINDER":
@@ -398,7 +465,7 @@ async def webhook(request: Request):
             
             # Custom schedule reminder: "recuérdame a las 4 tal cosa"
             if ("recuérdame a las" in desc_lower or "recuerdame a las" in desc_lower or "recuerdame a la" in desc_lower) and chat_id:
-                parsed = parse_schedule_reminder(user_text)
+                parsed = await parse_schedule_reminder(user_text)
                 if parsed:
                     saved = await save_custom_schedule_reminder(
                         chat_id=int(chat_id),
@@ -514,12 +581,9 @@ async def webhook(request: Request):
                                             if reminder_date_str:
                                                 date_str = f" [📅 {reminder_date_str}]"
                                             elif created:
-                                                try:
-                                                    from datetime import datetime
-                                                    created_dt = datetime.fromisoformat(created.replace('Z', '+00:00'))
-                                                    date_str = f" [{created_dt.strftime('%d/%m/%Y')}]"
-                                                except:
-                                                    pass
+                                                created_display = _iso_to_display(created)
+                                                if created_display:
+                                                    date_str = f" [{created_display}]"
                                             
                                             response_parts.append(f"  • {content}{date_str}")
                                     
@@ -539,12 +603,9 @@ async def webhook(request: Request):
                                         if reminder_date_str:
                                             date_str = f" [📅 {reminder_date_str}]"
                                         elif created:
-                                            try:
-                                                from datetime import datetime
-                                                created_dt = datetime.fromisoformat(created.replace('Z', '+00:00'))
-                                                date_str = f" [{created_dt.strftime('%d/%m/%Y')}]"
-                                            except:
-                                                pass
+                                            created_display = _iso_to_display(created)
+                                            if created_display:
+                                                date_str = f" [{created_display}]"
                                         
                                         response_parts.append(f"  • {content}{date_str}")
                                     
@@ -574,7 +635,6 @@ async def webhook(request: Request):
                     
                     # Extract date if mentioned (for reminders)
                     reminder_date = None
-                    from datetime import datetime, timedelta
                     if "mañana" in desc_lower or "tomorrow" in desc_lower:
                         reminder_date = (datetime.now() + timedelta(days=1)).date().isoformat()
                     elif "hoy" in desc_lower or "today" in desc_lower:
@@ -667,7 +727,15 @@ async def webhook(request: Request):
             # Route to Mentorship Layer - 100% mentoria, sin contexto financiero
             logger.info(f"Routing to Mentorship Layer")
             try:
-                response_text = generate_mentorship_advice(user_text, conversation_history=conversation_history)
+                if mentor_task:
+                    response_text = await mentor_task
+                elif chat_id:
+                    response_text = await stream_message(
+                        chat_id, stream_mentorship_advice(user_text, conversation_history=conversation_history)
+                    )
+                    response_sent = True
+                else:
+                    response_text = await generate_mentorship_advice(user_text, conversation_history=conversation_history)
             except Exception as e:
                 logger.error(f"Error generating mentorship advice: {str(e)}")
                 response_text = f"Error procesando tu mensaje: {str(e)}"
@@ -694,7 +762,7 @@ async def webhook(request: Request):
                             thought_type=None,
                             limit=10
                         )
-                    response_text = generate_operational_response(
+                    response_text = await generate_operational_response(
                         user_message=user_text,
                         conversation_history=conversation_history,
                         thoughts_context=thoughts_context
@@ -711,7 +779,7 @@ async def webhook(request: Request):
             logger.info(f"Routing to Finance Layer")
             
             # Classify financial action (save_thought is now handled before intent analysis)
-            classification = classify_financial_action(user_text)
+            classification = await classify_financial_action(user_text)
             logger.info(f"Classification from LLM: {classification}")
             
             action = classification.get("action", "unknown")
@@ -732,7 +800,7 @@ async def webhook(request: Request):
                 # User wants to check budget
                 if category:
                     budget_status = await get_budget_status(category)
-                    response_text = generate_cfo_response(
+                    response_text = await generate_cfo_response(
                         action=action,
                         amount=0,
                         category=category,
@@ -741,13 +809,13 @@ async def webhook(request: Request):
                         conversation_history=conversation_history
                     )
                 else:
-                    response_text = "¿Qué categoría quieres consultar? (fixed_survival, debt_offensive, kepler_growth, networking_life, stupid_expenses)"
+                    response_text = f"¿Qué categoría quieres consultar? ({', '.join(BUDGET_CATEGORIES)})"
             
             elif action == "income":
                 # Handle income
                 try:
                     await insert_transaction(amount=amount, category="income", description=description, transaction_type="income")
-                    response_text = generate_cfo_response(
+                    response_text = await generate_cfo_response(
                         action=action,
                         amount=amount,
                         category=None,
@@ -767,17 +835,14 @@ async def webhook(request: Request):
                     response_text = "El monto debe ser mayor a 0. Por favor, indica cuánto gastaste."
                 else:
                     try:
-                        # Step 3: Insert transaction
-                        await insert_transaction(
+                        # Step 3-4: Insert transaction + update budget + budget status (one RPC)
+                        budget_status = await register_expense(
                             amount=amount,
                             category=category,
                             description=description,
                             transaction_type="expense"
                         )
                         
-                        # Step 4: Update budget
-                        await update_budget_spent(category=category, amount=amount)
-                        
                         # Step 4.5: Check if this is a debt payment and update debt
                         # Update debt for both fixed_survival (monthly) and debt_offensive (extraordinary)
                         debt_name = detect_debt_payment(description, category, amount)
@@ -803,18 +868,26 @@ async def webhook(request: Request):
                                 except Exception as e:
                                     logger.warning(f"Could not update ICETEX debt balance: {str(e)}")
                         
-                        # Step 5: Get budget status
-                        budget_status = await get_budget_status(category)
-                        
-                        # Step 6: Generate response
-                        response_text = generate_cfo_response(
-                            action=action,
-                            amount=amount,
-                            category=category,
-                            description=description,
-                            budget_status=budget_status,
-                            conversation_history=conversation_history
-                        )
+                        # Step 5: Generate response (streamed to Telegram as it arrives)
+                        if chat_id:
+                            response_text = await stream_message(chat_id, stream_cfo_response(
+                                action=action,
+                                amount=amount,
+                                category=category,
+                                description=description,
+                                budget_status=budget_status,
+                                conversation_history=conversation_history
+                            ))
+                            response_sent = True
+                        else:
+                            response_text = await generate_cfo_response(
+                                action=action,
+                                amount=amount,
+                                category=category,
+                                description=description,
+                                budget_status=budget_status,
+                                conversation_history=conversation_history
+                            )
                         
                     except Exception as e:
                         logger.error(f"Error processing expense: {str(e)}")
@@ -847,8 +920,10 @@ async def webhook(request: Request):
             elif action == "check_patrimony":
                 # User wants to check patrimony
                 try:
-                    monthly_status = await calculate_monthly_patrimony()
-                    patrimony = await get_patrimony()
+                    monthly_status, patrimony = await asyncio.gather(
+                        calculate_monthly_patrimony(),
+                        get_patrimony(),
+                    )
                     
                     current_patrimony = float(patrimony.get("current_balance", 0) or 0) if patrimony else 0
                     monthly_income = monthly_status.get("monthly_income", 0)
@@ -870,17 +945,27 @@ async def webhook(request: Request):
             elif action == "financial_summary":
                 # User wants complete financial summary
                 try:
-                    from datetime import datetime
+                    # Debts, patrimony and budgets are independent: fetch them concurrently
+                    debts, monthly_status, patrimony, budgets = await asyncio.gather(
+                        get_all_debts(),
+                        calculate_monthly_patrimony(),
+                        get_patrimony(),
+                        get_budgets_bulk(),
+                        return_exceptions=True,
+                    )
+                    for result in (debts, monthly_status, patrimony):
+                        if isinstance(result, Exception):
+                            raise result
+                    # Budgets that fail to load are left out of the report, as before
+                    if isinstance(budgets, Exception):
+                        budgets = {}
                     
                     # Get debts
-                    debts = await get_all_debts()
                     total_debt = sum(float(d.get("current_balance", 0) or 0) for d in debts)
                     initial_debt_total = sum(float(d.get("initial_balance", 0) or 0) for d in debts)
                     debt_paid = initial_debt_total - total_debt
                     
                     # Get patrimony
-                    monthly_status = await calculate_monthly_patrimony()
-                    patrimony = await get_patrimony()
                     current_patrimony = float(patrimony.get("current_balance", 0) or 0) if patrimony else 0
                     initial_patrimony = float(patrimony.get("initial_balance", 0) or 0) if patrimony else 0
                     patrimony_growth = current_patrimony - initial_patrimony
@@ -892,37 +977,27 @@ async def webhook(request: Request):
                     projected_patrimony = monthly_status.get("projected_patrimony", current_patrimony)
                     
                     # Get all budgets with details
-                    budget_categories = ["fixed_survival", "debt_offensive", "kepler_growth", "networking_life", "stupid_expenses"]
-                    category_names = {
-                        "fixed_survival": "Gastos Fijos/Sobrevivencia",
-                        "debt_offensive": "Pagos Extra Deuda",
-                        "kepler_growth": "Inversión Negocio",
-                        "networking_life": "Vida Social/Networking",
-                        "stupid_expenses": "Gastos Innecesarios"
-                    }
-                    
                     budgets_detail = []
                     total_spent = 0
                     total_limit = 0
-                    for cat in budget_categories:
-                        try:
-                            budget = await get_budget_status(cat)
-                            spent = float(budget.get('current_spent', 0) or 0)
-                            limit = float(budget.get('monthly_limit', 0) or 0)
-                            remaining = budget.get('remaining', 0)
-                            percentage = (spent / limit * 100) if limit > 0 else 0
-                            total_spent += spent
-                            total_limit += limit
-                            budgets_detail.append({
-                                "name": category_names.get(cat, cat),
-                                "category": cat,
-                                "spent": spent,
-                                "limit": limit,
-                                "remaining": remaining,
-                                "percentage": percentage
-                            })
-                        except:
-                            pass
+                    for cat in BUDGET_CATEGORIES:
+                        budget = budgets.get(cat)
+                        if not budget:
+                            continue
+                        spent = float(budget.get('current_spent', 0) or 0)
+                        limit = float(budget.get('monthly_limit', 0) or 0)
+                        remaining = limit - spent
+                        percentage = (spent / limit * 100) if limit > 0 else 0
+                        total_spent += spent
+                        total_limit += limit
+                        budgets_detail.append({
+                            "name": CATEGORY_NAMES.get(cat, cat),
+                            "category": cat,
+                            "spent": spent,
+                            "limit": limit,
+                            "remaining": remaining,
+                            "percentage": percentage
+                        })
                     
                     # Get current date info
                     today = datetime.now()
@@ -1075,13 +1150,22 @@ async def webhook(request: Request):
                     # Get complete financial state
                     financial_state = await get_complete_financial_state()
                     
-                    # Generate spending advice using the guardian/coach logic
-                    response_text = generate_spending_advice(
-                        user_query=user_text,
-                        amount=amount if amount > 0 else 0,
-                        financial_state=financial_state,
-                        conversation_history=conversation_history
-                    )
+                    # Generate spending advice using the guardian/coach logic (streamed)
+                    if chat_id:
+                        response_text = await stream_message(chat_id, stream_spending_advice(
+                            user_query=user_text,
+                            amount=amount if amount > 0 else 0,
+                            financial_state=financial_state,
+                            conversation_history=conversation_history
+                        ))
+                        response_sent = True
+                    else:
+                        response_text = await generate_spending_advice(
+                            user_query=user_text,
+                            amount=amount if amount > 0 else 0,
+                            financial_state=financial_state,
+                            conversation_history=conversation_history
+                        )
                 except Exception as e:
                     logger.error(f"Error generating spending advice: {str(e)}")
                     response_text = f"Error analizando tu consulta: {str(e)}"
@@ -1140,7 +1224,7 @@ async def webhook(request: Request):
                     )
                     
                     # Generate response
-                    response_text = generate_transaction_query_response(
+                    response_text = await generate_transaction_query_response(
                         user_query=user_text,
                         transactions=transactions,
                         conversation_history=conversation_history
@@ -1203,12 +1287,7 @@ async def webhook(request: Request):
                             # Format date
                             date_str = ""
                             if created_at:
-                                try:
-                                    from datetime import datetime
-                                    dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                                    date_str = dt.strftime("%d/%m/%Y %H:%M")
-                                except:
-                                    date_str = created_at.split("T")[0] if "T" in created_at else created_at
+                                date_str = _iso_to_display(created_at, with_time=True) or created_at
                             
                             status = "✅" if is_completed else ""
                             type_emoji = {"reminder": "🔔", "idea": "💡", "note": "📄", "thought": "💭"}.get(t_type, "📝")
@@ -1229,21 +1308,24 @@ async def webhook(request: Request):
             else:
                 response_text = "Acción no reconocida. Por favor, intenta de nuevo."
         
-        # Step 7: Save conversation messages to history
-        try:
-            await save_conversation_message(chat_id=chat_id, role="user", message=user_text, intent=intent)
-            await save_conversation_message(chat_id=chat_id, role="assistant", message=response_text, intent=intent)
-        except Exception as e:
-            logger.warning(f"Could not save conversation history: {str(e)}")
+        # Step 7: Save conversation messages to history (in the background, the
+        # reply below does not wait for the inserts; failures are logged)
+        save_tasks = [
+            save_conversation_message_bg(chat_id=chat_id, role="user", message=user_text, intent=intent),
+            save_conversation_message_bg(chat_id=chat_id, role="assistant", message=response_text, intent=intent),
+        ]
         
-        # Step 8: Send response to Telegram
-        if chat_id:
+        # Step 8: Send response to Telegram (unless it was already streamed)
+        if chat_id and not response_sent:
             try:
                 await send_message(chat_id=chat_id, text=response_text)
                 logger.info(f"Message sent to chat {chat_id}")
             except Exception as e:
                 logger.error(f"Error sending message to Telegram: {str(e)}")
         
+        # Vercel puede congelar la función al responder: terminar las escrituras antes
+        await asyncio.wait(save_tasks)
+        
         # Return response for logging/debugging
         logger.info(f"Response: {response_text}")
         
@@ -8,13 +8,42 @@ ARCHITECTURE:
 Mental Models: Dweck, Naval, Manson, Carnegie, YC, Bezos, Musk, Borrero, Vega.
 """
 import os
-import json
-from typing import Dict, Any, Optional
-from openai import OpenAI
+import re
+import logging
+import orjson
+import time
+import random
+import asyncio
+import hashlib
+from collections import deque
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from typing import Dict, Any, Optional, AsyncIterator, Callable
+import httpx
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
 from dotenv import load_dotenv
+from core.cache import TTLCache
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# HTTP/2 (varias llamadas paralelas por un solo socket) solo si el extra h2 está instalado
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+# Variables de entorno capturadas una sola vez al importar
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+KEPLER_TZ = os.getenv("KEPLER_TZ", "America/Bogota")
+# Zona horaria resuelta una vez; None = hora local del servidor si no se puede cargar
+try:
+    KEPLER_TZINFO = ZoneInfo(KEPLER_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    KEPLER_TZINFO = None
+
 # Initialize OpenAI client (lazy initialization)
 _client = None
 
@@ -22,18 +51,211 @@ def get_openai_client():
     """Get or create OpenAI client."""
     global _client
     if _client is None:
-        api_key = os.getenv("OPENAI_API_KEY")
+        api_key = OPENAI_API_KEY
         if not api_key:
             raise ValueError("OPENAI_API_KEY must be set in environment variables")
-        _client = OpenAI(api_key=api_key)
+        # Los reintentos viven en _chat_completion (respetan el rate limiter); sin reintentos anidados del SDK
+        _client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                http2=_HTTP2_AVAILABLE,
+                timeout=30.0,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            ),
+        )
     return _client
 
-def parse_schedule_reminder(user_message: str) -> Optional[Dict[str, Any]]:
+
+async def close_openai_client() -> None:
+    """Cierra el cliente de OpenAI y su pool de conexiones (al apagar la app)."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+# =============================================================================
+# CONCURRENCIA Y RATE LIMIT (OpenAI)
+# =============================================================================
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENCY", "10"))
+# Tope propio de requests por minuto (por debajo del tier de gpt-4o-mini)
+MAX_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_MAX_RPM", "500"))
+MAX_RATE_LIMIT_ATTEMPTS = 5
+
+# Se crea perezosamente para quedar ligado al event loop que lo usa
+_semaphore: Optional[asyncio.Semaphore] = None
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+
+def _parse_reset_seconds(value: Optional[str]) -> float:
+    """Convierte '6m0s', '1.5s' o '20ms' (headers x-ratelimit-reset-*) a segundos."""
+    if not value:
+        return 0.0
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(num) * units[unit] for num, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value))
+
+
+class RateLimiter:
     """
-    Extrae hora, minuto, mensaje y fecha de "recuérdame a las 4 que tengo reunión".
-    Returns: {hour, minute, message, specific_date} or None si no pudo parsear.
+    Token bucket alimentado por los headers x-ratelimit-* de OpenAI.
+    Antes de cada llamada reserva 1 request y los tokens estimados; si el cupo
+    conocido no alcanza, espera al reset en vez de provocar un 429.
+    Además aplica una ventana deslizante propia de max_rpm requests por minuto,
+    que cubre el arranque en frío antes de conocer los headers.
+    """
+
+    def __init__(self, max_rpm: int = MAX_REQUESTS_PER_MINUTE):
+        self.requests_remaining: Optional[int] = None
+        self.tokens_remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.max_rpm = max_rpm
+        self._sent_at: deque = deque()
+
+    async def _acquire_window(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._sent_at and now - self._sent_at[0] >= 60.0:
+                self._sent_at.popleft()
+            if len(self._sent_at) < self.max_rpm:
+                self._sent_at.append(now)
+                return
+            await asyncio.sleep(60.0 - (now - self._sent_at[0]))
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        await self._acquire_window()
+        now = time.monotonic()
+        if now >= self.reset_at:
+            # Ventana vencida: el cupo real se conocerá con la próxima respuesta
+            self.requests_remaining = None
+            self.tokens_remaining = None
+        elif (self.requests_remaining is not None and self.requests_remaining < 1) or (
+            self.tokens_remaining is not None and self.tokens_remaining < estimated_tokens
+        ):
+            await asyncio.sleep(self.reset_at - now)
+            self.requests_remaining = None
+            self.tokens_remaining = None
+
+        if self.requests_remaining is not None:
+            self.requests_remaining -= 1
+        if self.tokens_remaining is not None:
+            self.tokens_remaining -= estimated_tokens
+
+    def update(self, headers) -> None:
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.requests_remaining = int(remaining_requests)
+        if remaining_tokens is not None:
+            self.tokens_remaining = int(remaining_tokens)
+        reset = max(
+            _parse_reset_seconds(headers.get("x-ratelimit-reset-requests")),
+            _parse_reset_seconds(headers.get("x-ratelimit-reset-tokens")),
+        )
+        if reset:
+            self.reset_at = time.monotonic() + reset
+
+
+_rate_limiter = RateLimiter()
+
+
+def _estimate_tokens(messages: list, max_tokens: Optional[int]) -> int:
+    """Estimación gruesa (~4 caracteres por token) de prompt + completion."""
+    prompt_chars = sum(len(m.get("content") or "") for m in messages)
+    return prompt_chars // 4 + (max_tokens or 500)
+
+
+def _log_usage(model: Optional[str], usage) -> None:
+    """
+    Registra tokens de prompt y cuántos salieron del prompt caching automático
+    de OpenAI (prefijos idénticos >= 1024 tokens). Por eso los system prompts
+    son constantes y todo lo dinámico va en el mensaje del usuario.
+    """
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    logger.info(f"OpenAI {model}: prompt_tokens={usage.prompt_tokens} cached_tokens={cached}")
+
+
+async def _chat_completion(**kwargs):
     """
-    system_prompt = """Extrae de este mensaje la HORA y el MENSAJE del recordatorio.
+    Wrapper único sobre chat.completions.create.
+    Acota la concurrencia, respeta el rate limit reportado por OpenAI y
+    reintenta los 429, errores de conexión y 5xx (Retry-After o backoff
+    exponencial con jitter).
+
+    Nota: el SDK serializa el body completo en cada llamada y no acepta
+    fragmentos JSON pre-codificados. Los _*_SYS_MSG compartidos evitan
+    reconstruir el dict; armar el body a mano con httpx para ahorrar la
+    codificación perdería los reintentos y el tipado del SDK.
+    """
+    client = get_openai_client()
+    estimated_tokens = _estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    for attempt in range(MAX_RATE_LIMIT_ATTEMPTS):
+        async with _get_semaphore():
+            await _rate_limiter.acquire(estimated_tokens)
+            try:
+                raw = await client.chat.completions.with_raw_response.create(**kwargs)
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == MAX_RATE_LIMIT_ATTEMPTS - 1:
+                    raise
+                error_response = getattr(e, "response", None)
+                retry_after = error_response.headers.get("retry-after") if error_response is not None else None
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = min(2 ** attempt, 30) * (0.5 + random.random())
+            else:
+                _rate_limiter.update(raw.headers)
+                response = raw.parse()
+                if not kwargs.get("stream"):
+                    _log_usage(kwargs.get("model"), getattr(response, "usage", None))
+                return response
+        await asyncio.sleep(delay)
+
+
+async def _stream_completion(fallback: str, on_complete: Optional[Callable[[str], None]] = None, **kwargs) -> AsyncIterator[str]:
+    """
+    Versión streaming de _chat_completion: entrega el texto por fragmentos.
+    Si falla antes del primer fragmento, entrega el fallback completo.
+    on_complete recibe el texto entero solo si el stream terminó sin error.
+    """
+    pieces = []
+    try:
+        stream = await _chat_completion(stream=True, stream_options={"include_usage": True}, **kwargs)
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                _log_usage(kwargs.get("model"), chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                yield pieces[-1]
+    except Exception:
+        if not pieces:
+            yield fallback
+        return
+    if on_complete and pieces:
+        on_complete("".join(pieces))
+
+
+def _build_messages(system_msg: Dict[str, str], conversation_history: Optional[list], user_content: str) -> list:
+    """Arma [system, historial..., user] filtrando roles y mensajes vacíos del historial."""
+    messages = [system_msg]
+    if conversation_history:
+        for msg in conversation_history:
+            msg_role = msg.get('role', 'user')
+            msg_content = msg.get('message', '')
+            if msg_role in ['user', 'assistant'] and msg_content:
+                messages.append({"role": msg_role, "content": msg_content})
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+_SCHEDULE_SYSTEM_PROMPT = """Extrae de este mensaje la HORA y el MENSAJE del recordatorio.
 
 Ejemplos:
 - "recuérdame a las 4 que tengo reunión" -> hour=4, minute=0, message="que tengo reunión"
@@ -45,12 +267,18 @@ Ejemplos:
 Reglas: hour 0-23, minute 0-59. Si dice "pm" o "tarde/noche" y la hora es <12, suma 12.
 Si dice "mañana" -> specific_date="tomorrow". Si no, specific_date=null.
 Responde SOLO JSON: {"hour": N, "minute": N, "message": "texto", "specific_date": null o "tomorrow"}"""
+_SCHEDULE_SYS_MSG = {"role": "system", "content": _SCHEDULE_SYSTEM_PROMPT}
+
+async def parse_schedule_reminder(user_message: str) -> Optional[Dict[str, Any]]:
+    """
+    Extrae hora, minuto, mensaje y fecha de "recuérdame a las 4 que tengo reunión".
+    Returns: {hour, minute, message, specific_date} or None si no pudo parsear.
+    """
     try:
-        client = get_openai_client()
-        response = client.chat.completions.create(
+        response = await _chat_completion(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                _SCHEDULE_SYS_MSG,
                 {"role": "user", "content": user_message}
             ],
             temperature=0,
@@ -59,7 +287,7 @@ Responde SOLO JSON: {"hour": N, "minute": N, "message": "texto", "specific_date"
         content = response.choices[0].message.content.strip()
         if "```" in content:
             content = content.split("```")[1].replace("json", "").strip()
-        result = json.loads(content)
+        result = orjson.loads(content)
         hour = int(result.get("hour", 0))
         minute = int(result.get("minute", 0))
         message = str(result.get("message", "")).strip()
@@ -67,15 +295,7 @@ Responde SOLO JSON: {"hour": N, "minute": N, "message": "texto", "specific_date"
             message = "Recordatorio"
         specific_date = result.get("specific_date")
         if specific_date == "tomorrow":
-            from datetime import datetime, timedelta
-            tz_name = os.getenv("KEPLER_TZ", "America/Bogota")
-            try:
-                import pytz
-                tz = pytz.timezone(tz_name)
-                tomorrow = (datetime.now(tz) + timedelta(days=1)).date().isoformat()
-            except Exception:
-                tomorrow = (datetime.now() + timedelta(days=1)).date().isoformat()
-            specific_date = tomorrow
+            specific_date = (datetime.now(KEPLER_TZINFO) + timedelta(days=1)).date().isoformat()
         else:
             specific_date = None
         return {"hour": hour, "minute": minute, "message": message, "specific_date": specific_date}
@@ -92,35 +312,17 @@ VALID_CATEGORIES = [
     "stupid_expenses"  # 0% idealmente
 ]
 
+VALID_ACTIONS = [
+    "expense", "income", "check_budget", "check_debt", "check_patrimony",
+    "financial_summary", "close_month", "consult_spending",
+    "query_transaction", "query_thoughts", "unknown"
+]
+
 # =============================================================================
 # CAPA 1: EL ROUTER MAESTRO (Intention Layer)
 # =============================================================================
 
-def analyze_intent(user_message: str) -> str:
-    """
-    LAYER 1: The Gatekeeper.
-    Decides if the user needs the CFO (Finance), the Mentor (Psychology/Strategy), or Reminder (Save thoughts/ideas).
-    """
-    # PRIORIDAD 1: Detectar comandos relacionados con REMINDER
-    user_lower = user_message.lower().strip()
-    
-    # Detectar prefijo "reminder:" o "recordatorio:" para consultas
-    if user_lower.startswith("reminder:") or user_lower.startswith("recordatorio:"):
-        return "REMINDER"
-    
-    # Detectar comandos de guardado (guarda, guarda esta, guarda este, etc.)
-    save_keywords = [
-        "guarda", "guarda esta", "guarda este", "guarda idea", 
-        "guarda recordatorio", "guarda pensamiento", "guarda nota"
-    ]
-    if any(keyword in user_lower for keyword in save_keywords):
-        return "REMINDER"
-    # Detectar recordatorio programado "recuérdame a las X"
-    if "recuérdame a las" in user_lower or "recuerdame a las" in user_lower or "recuerdame a la" in user_lower:
-        return "REMINDER"
-    
-    # Si no es REMINDER, usar LLM para clasificar entre FINANCE, MENTORSHIP y OPERATIONAL
-    system_prompt = """Eres el sistema de triaje mental de un CEO. Tu única misión es redirigir el mensaje.
+_ROUTER_SYSTEM_PROMPT = """Eres el sistema de triaje mental de un CEO. Tu única misión es redirigir el mensaje.
 
 CLASIFICACIÓN:
 
@@ -149,12 +351,37 @@ REGLA DE ORO:
 
 Responde SOLAMENTE una palabra: "FINANCE", "MENTORSHIP" o "OPERATIONAL".
 """
+_ROUTER_SYS_MSG = {"role": "system", "content": _ROUTER_SYSTEM_PROMPT}
+
+async def analyze_intent(user_message: str) -> str:
+    """
+    LAYER 1: The Gatekeeper.
+    Decides if the user needs the CFO (Finance), the Mentor (Psychology/Strategy), or Reminder (Save thoughts/ideas).
+    """
+    # PRIORIDAD 1: Detectar comandos relacionados con REMINDER
+    user_lower = user_message.lower().strip()
+    
+    # Detectar prefijo "reminder:" o "recordatorio:" para consultas
+    if user_lower.startswith("reminder:") or user_lower.startswith("recordatorio:"):
+        return "REMINDER"
+    
+    # Detectar comandos de guardado (guarda, guarda esta, guarda este, etc.)
+    save_keywords = [
+        "guarda", "guarda esta", "guarda este", "guarda idea", 
+        "guarda recordatorio", "guarda pensamiento", "guarda nota"
+    ]
+    if any(keyword in user_lower for keyword in save_keywords):
+        return "REMINDER"
+    # Detectar recordatorio programado "recuérdame a las X"
+    if "recuérdame a las" in user_lower or "recuerdame a las" in user_lower or "recuerdame a la" in user_lower:
+        return "REMINDER"
+    
+    # Si no es REMINDER, usar LLM para clasificar entre FINANCE, MENTORSHIP y OPERATIONAL
     try:
-        client = get_openai_client()
-        response = client.chat.completions.create(
+        response = await _chat_completion(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                _ROUTER_SYS_MSG,
                 {"role": "user", "content": user_message}
             ],
             temperature=0.0, # Cero creatividad, pura lógica
@@ -172,219 +399,376 @@ Responde SOLAMENTE una palabra: "FINANCE", "MENTORSHIP" o "OPERATIONAL".
 # CAPA 2A: EL CFO (Finance Layer)
 # =============================================================================
 
-def classify_financial_action(user_message: str) -> Dict[str, Any]:
+_CLASSIFY_SYSTEM_PROMPT = """Clasifica el mensaje financiero. Devuelve action, amount (COP, 0 si no hay), category (del gasto o del presupuesto consultado; si no aplica, null) y description breve.
+
+CATEGORÍAS:
+fixed_survival=arriendo/servicios/seguridad social/cuota mínima icetex-lumni
+debt_offensive=abono EXTRA a deuda
+kepler_growth=negocio: AWS/APIs/cursos/herramientas
+networking_life=salidas/ocio/social
+stupid_expenses=impulso/hormiga/lujos
+
+ACCIONES: expense=gasto hecho | income=ingreso | check_budget=saldo | check_debt=deudas | check_patrimony=patrimonio | financial_summary=resumen | close_month=cierre de mes | consult_spending="¿debería/puedo comprar X?" | query_transaction="¿cuánto/qué/cuándo gasté?" | query_thoughts="mis recordatorios/pensamientos" | unknown=otro
+
+REGLAS: lumni/icetex+extra/abono -> debt_offensive; lumni/icetex solo -> fixed_survival; duda networking vs stupid -> stupid_expenses."""
+_CLASSIFY_SYS_MSG = {"role": "system", "content": _CLASSIFY_SYSTEM_PROMPT}
+
+# Structured Outputs: el modelo solo puede devolver acciones y categorías válidas
+_CLASSIFY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "financial_action",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["action", "amount", "category", "description"],
+            "properties": {
+                "action": {"type": "string", "enum": VALID_ACTIONS},
+                "amount": {"type": "number"},
+                "category": {"type": ["string", "null"], "enum": VALID_CATEGORIES + [None]},
+                "description": {"type": "string"},
+            },
+        },
+    },
+}
+
+# --- NIVEL LOCAL (sin LLM) para gastos triviales: "gasté 20000 en cine" ---
+_EXPENSE_VERB_RE = re.compile(r"\b(gast[eé]|pagu[eé]|compr[eé])\b")
+_AMOUNT_RE = re.compile(r"\$?\s*(\d+(?:[.,]\d+)*)\s*(k|mil|millones|mill[oó]n)?\b")
+_AMOUNT_MULTIPLIERS = {"k": 1_000, "mil": 1_000, "millon": 1_000_000, "millón": 1_000_000, "millones": 1_000_000}
+
+# Moneda extranjera o negación: el monto/intención no es un gasto COP simple -> LLM
+_LOCAL_ESCALATE_RE = re.compile(r"us\$|€|\b(usd|eur|euros?|d[oó]lar(es)?|no|nunca|sin)\b")
+# Marcadores de pago EXTRA a deuda: si aparecen fuera de un concepto debt_offensive,
+# la intención es ambigua ("pagué 300000 extra de icetex") y decide el LLM
+_DEBT_EXTRA_RE = re.compile(r"\b(extras?|abonos?|adicional(es)?)\b")
+# Concepto = todo lo que sigue a "en/de/del" hasta el final ("gasté 20000 en arriendo")
+_CONCEPT_SLOT_RE = re.compile(
+    r"\b(?:en|de|del)\s+(?:(?:el|la|los|las|mi|mis|un|una)\s+)?([a-záéíóúñ]+(?:\s+[a-záéíóúñ]+)*)$"
+)
+
+# Solo conceptos inequívocos de las reglas del prompt, comparados contra el concepto
+# completo (fullmatch); networking vs stupid lo decide el LLM
+_LOCAL_CATEGORY_PATTERNS = [
+    ("debt_offensive", re.compile(
+        r"abono( extra| adicional)? ((a|al|de|del) )?(lumni|icetex)"
+        r"|(pago|cuota) (extra|adicional) ((a|al|de|del) )?(lumni|icetex)"
+        r"|(lumni|icetex) (extra|adicional)"
+    )),
+    ("fixed_survival", re.compile(
+        r"arriendo|servicios( p[uú]blicos)?|seguridad social"
+        r"|((cuota|pago)( m[ií]nim[ao])? ((a|al|de|del) )?)?(lumni|icetex)"
+    )),
+    ("kepler_growth", re.compile(r"aws|vercel|apis?|openai|dominio|hosting|servidor|cursos?")),
+]
+
+
+# Comandos cortos de consulta sin monto: "saldo", "mis deudas", "resumen", "cierre de mes"
+_LOCAL_QUERY_PATTERNS = [
+    ("check_budget", re.compile(r"^(cu[aá]nto (me )?(queda|tengo)|(mi |el )?saldo|(mi |mis |el )?presupuestos?)$")),
+    ("check_debt", re.compile(r"^(cu[aá]nto debo|(mis |las )?deudas?)\s*\??$")),
+    ("check_patrimony", re.compile(r"^(mi |el )?patrimonio\s*\??$")),
+    ("financial_summary", re.compile(r"^(el |un |mi )?resumen( financiero| total| del mes)?$")),
+    # close_month no es idempotente: solo la frase completa con "mes"; lo demás lo decide el LLM
+    ("close_month", re.compile(r"^(cierre|cerrar)( del?| el)? mes$")),
+]
+_LOCAL_QUERY_MAX_WORDS = 4
+# "arriendo 1.200.000": concepto + monto, sin verbo
+_NOUN_AMOUNT_RE = re.compile(r"^([a-záéíóúñ ]+?)\s\$?\s*\d[\d.,]*\s*(k|mil)?$")
+
+
+def _parse_amount(text: str) -> Optional[float]:
+    """
+    Extrae el único monto del texto ("20000", "20.000", "20k", "1,5 millones").
+    Devuelve None si no hay monto o hay más de un número (ambiguo).
+    """
+    matches = _AMOUNT_RE.findall(text)
+    if len(matches) != 1:
+        return None
+    number, suffix = matches[0]
+    if suffix:
+        value = float(number.replace(",", "."))
+        return value * _AMOUNT_MULTIPLIERS[suffix]
+    groups = re.split(r"[.,]", number)
+    if len(groups) > 1 and any(len(g) != 3 for g in groups[1:]):
+        return None  # "20.5" sin sufijo: mejor que decida el LLM
+    return float("".join(groups))
+
+
+def _local_classify_expense(user_message: str) -> Optional[Dict[str, Any]]:
+    """
+    Clasificador barato para comandos de consulta cortos y gastos sin ambigüedad.
+    Devuelve None cuando no hay confianza suficiente (sin verbo de gasto, pregunta,
+    monto ambiguo o categoría dudosa) para escalar a OpenAI.
+    """
+    text = user_message.lower().strip()
+    query = text.strip("¿?¡!. ")
+    if len(query.split()) <= _LOCAL_QUERY_MAX_WORDS and not any(ch.isdigit() for ch in query):
+        for action, pattern in _LOCAL_QUERY_PATTERNS:
+            if pattern.search(query):
+                return {"action": action, "amount": 0, "category": None, "description": ""}
+    text = text.rstrip(".!¡ ")
+    noun_amount = _NOUN_AMOUNT_RE.match(text)
+    if "?" in text or not (_EXPENSE_VERB_RE.search(text) or noun_amount):
+        return None
+    if _LOCAL_ESCALATE_RE.search(text):
+        return None
+    amount = _parse_amount(text)
+    if not amount:
+        return None
+    if noun_amount:
+        concept = noun_amount.group(1).strip()
+    else:
+        slot = _CONCEPT_SLOT_RE.search(text)
+        if not slot:
+            return None
+        concept = slot.group(1)
+    for category, pattern in _LOCAL_CATEGORY_PATTERNS:
+        if pattern.fullmatch(concept):
+            if category != "debt_offensive" and _DEBT_EXTRA_RE.search(text):
+                return None
+            return {"action": "expense", "amount": amount, "category": category, "description": user_message.strip()}
+    return None
+
+
+def _normalize_text(text: str) -> str:
+    """Minúsculas y espacios colapsados: "Café  5000 " -> "café 5000"."""
+    return " ".join((text or "").lower().split())
+
+
+# Mensajes repetidos ("café 5000", "cuánto tengo") reutilizan la clasificación previa
+_CLASSIFY_CACHE = TTLCache(maxsize=512, ttl=24 * 3600)
+
+
+async def classify_financial_action(user_message: str) -> Dict[str, Any]:
     """
     LAYER 2A: The Strict CFO.
     Solo se ejecuta si el Router decide que es 'FINANCE'.
     Extrae datos estructurados para la base de datos.
+    Primero intenta el clasificador local; solo escala a OpenAI si no es trivial.
     """
-    system_prompt = """Eres el motor financiero de Kepler. Procesas transacciones con precisión quirúrgica.
-
-CONTEXTO DEL PRESUPUESTO (Estricto):
-- Ingreso Total: ~$2.845.132 COP
-- fixed_survival ($1.714.300): Arriendo, servicios, seguridad social, cuota MÍNIMA icetex/lumni.
-- debt_offensive ($412.850): Pagos EXTRA a deuda (Guerra contra pasivos).
-- kepler_growth ($412.850): Inversión negocio (AWS, APIs, Cursos).
-- networking_life ($309.000): Salidas estratégicas y ocio.
-- stupid_expenses: Gastos hormiga, lujos basura.
-
-ACCIONES VÁLIDAS:
-- "expense": Gasto realizado.
-- "income": Ingreso de dinero.
-- "check_budget": Ver saldo.
-- "check_debt": Ver deudas.
-- "check_patrimony": Ver patrimonio.
-- "financial_summary": Resumen total.
-- "close_month": Cierre de mes.
-- "consult_spending": Pregunta "¿Debería comprar X?" (Evaluación financiera).
-- "query_transaction": Pregunta sobre transacciones pasadas (ej: "¿Cuánto gasté en X?", "¿Cuándo gasté Y?", "¿Qué gastos hice esta semana?").
-- "query_thoughts": Consultar pensamientos/recordatorios (ej: "muéstrame mis recordatorios de hoy", "¿qué pensamientos guardé ayer?").
-
-REGLAS DE CLASIFICACIÓN (EN ORDEN DE PRIORIDAD):
-1. Si menciona "Lumni/Icetex" y "Extra/Abono" -> debt_offensive.
-2. Si menciona "Lumni/Icetex" y nada más (cuota normal) -> fixed_survival.
-3. Ante duda entre networking y stupid -> stupid_expenses.
-4. "Consultar gastos" o "¿puedo gastar?" -> action: "consult_spending".
-5. Pregunta sobre transacciones pasadas ("¿cuánto gasté?", "¿qué gastos?", "¿cuándo?", "muéstrame") -> action: "query_transaction".
-6. Consultas sobre pensamientos ("muéstrame mis recordatorios", "¿qué pensamientos guardé?", "recordatorios de hoy") -> action: "query_thoughts".
-
-NOTA: Los comandos "guarda" se manejan en otra capa (REMINDER), no llegan aquí.
-
-Responde SOLO JSON:
-{
-    "action": "action_name",
-    "amount": 0.0,
-    "category": "valid_category_or_null",
-    "description": "text"
-}
-"""
+    local_result = _local_classify_expense(user_message)
+    if local_result:
+        return local_result
+
+    cache_key = _normalize_text(user_message)
+    cached = _CLASSIFY_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        client = get_openai_client()
-        response = client.chat.completions.create(
+        response = await _chat_completion(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                _CLASSIFY_SYS_MSG,
                 {"role": "user", "content": user_message}
             ],
-            response_format={"type": "json_object"},
-            temperature=0.1
+            response_format=_CLASSIFY_RESPONSE_FORMAT,
+            temperature=0
         )
         content = response.choices[0].message.content
-        result = json.loads(content)
-
-        # Validación forzada de categorías
-        if result.get("category") and result["category"] not in VALID_CATEGORIES:
-            cat = result["category"].lower()
-            if "survival" in cat or "fijo" in cat: result["category"] = "fixed_survival"
-            elif "deuda" in cat or "debt" in cat: result["category"] = "debt_offensive"
-            elif "kepler" in cat or "negocio" in cat: result["category"] = "kepler_growth"
-            elif "networking" in cat or "social" in cat: result["category"] = "networking_life"
-            elif "tonto" in cat or "stupid" in cat: result["category"] = "stupid_expenses"
-            else: result["category"] = "fixed_survival" # Default seguro
+        result = orjson.loads(content)
 
+        _CLASSIFY_CACHE.set(cache_key, dict(result))
         return result
     except Exception as e:
         return {"action": "unknown", "amount": 0, "category": None, "description": str(e)}
 
-def generate_cfo_response(
+_USER_PROFILE = """USUARIO: 25 años, trabaja en startup, le gustan la ciencia y el deporte (fútbol semanal), tiene novia (vida social activa), empieza a ganar bien y quiere emprender para generar más dinero."""
+
+_CFO_SYSTEM_PROMPT = f"""Eres "Kepler CFO", su asistente financiero personal.
+{_USER_PROFILE}
+
+FILOSOFÍA:
+- REALISTA, no dogmático: NO regañes por agua/comida básica, gastos pequeños razonables, salud/deporte.
+- SÍ regaña por: gastos excesivos sin sentido (ej: 400k en trago), impulsivos grandes, decisiones claramente malas.
+- Vida social con límites: 30k con amigos -> "Está bien, pero no lo hagas seguido; nada más de salidas este mes hasta recuperar el presupuesto".
+- Usa el HISTORIAL: recuerda compromisos ("Dijiste que no gastarías en X") y patrones ("Ya es la tercera vez este mes...").
+- Tono de amigo/mentor: explica POR QUÉ, motiva cuando lo hace bien, firme pero no agresivo.
+
+PRESUPUESTOS:
+- fixed_survival ($1.714.300): Arriendo, servicios, seguridad social, cuota MÍNIMA icetex/lumni
+- debt_offensive ($412.850): Pagos EXTRA a deuda
+- kepler_growth ($412.850): Negocio/emprendimiento (AWS, APIs, Cursos)
+- networking_life ($309.000): Salidas estratégicas y ocio
+- stupid_expenses: Gastos hormiga, lujos innecesarios
+
+PRESUPUESTO DEL MENSAJE: B=límite, S=gastado, R=restante (COP).
+FORMATO: Máximo 3-4 líneas.
+REGLA DE ORO: Coach financiero realista; la disciplina sirve para lograr objetivos, no para vivir infeliz."""
+_CFO_SYS_MSG = {"role": "system", "content": _CFO_SYSTEM_PROMPT}
+
+def _fmt_cop(value) -> str:
+    """Formatea un monto como "$1,234,567 COP" (redondeado a pesos)."""
+    return f"${round(float(value or 0)):,} COP"
+
+
+# Cierres de plantilla por categoría para gastos de bajo impacto (sin llamar a OpenAI)
+_CFO_TEMPLATE_TAILS = {
+    "fixed_survival": [
+        "Gasto fijo cubierto. Así se sostiene la base.",
+        "Cumplido. Lo fijo al día es lo que te deja atacar lo demás.",
+    ],
+    "debt_offensive": [
+        "💪 Cada abono extra acorta la guerra contra la deuda.",
+        "Bien. Menos deuda = más libertad el próximo mes.",
+        "Ese abono trabaja para ti. Sigue así.",
+    ],
+    "kepler_growth": [
+        "Inversión en el negocio. Que se note en resultados.",
+        "Bien usado si te acerca a clientes o producto. Mídelo.",
+        "Crecimiento registrado. Que cada peso aquí tenga retorno.",
+    ],
+    "networking_life": [
+        "Vas bien de presupuesto social. Disfruta con cabeza.",
+        "Está dentro del plan. La vida social también suma.",
+        "Todo en orden. Solo no lo vuelvas costumbre diaria.",
+    ],
+}
+
+
+def _is_low_stakes_expense(amount: float, budget_status: Optional[Dict[str, Any]]) -> bool:
+    """Gasto pequeño (<10% del límite) con presupuesto sano (>20% restante)."""
+    if not budget_status:
+        return False
+    limit = float(budget_status.get('monthly_limit', 0) or 0)
+    remaining = float(budget_status.get('remaining', 0) or 0)
+    return limit > 0 and remaining > 0.2 * limit and float(amount or 0) < 0.1 * limit
+
+
+def _cfo_template_response(
     action: str,
     amount: float,
     category: Optional[str],
     description: str,
-    budget_status: Optional[Dict[str, Any]] = None,
-    conversation_history: Optional[list] = None
+    budget_status: Optional[Dict[str, Any]] = None
 ) -> str:
     """
-    Genera la respuesta de texto del CFO (Personalidad: Realista, Contextual y Educativa).
+    Respuesta determinística del CFO para casos donde la personalidad no aporta
+    (ingresos, consultas de saldo, gastos fijos). No llama a OpenAI.
     """
-    system_prompt = """Eres "Kepler CFO", el asistente financiero personal de un joven de 25 años que trabaja en una startup, le gusta la ciencia y el deporte, juega fútbol 1 vez por semana, tiene novia, está empezando a ganar bien y quiere emprender para generar más dinero.
-
-TU CONTEXTO DEL USUARIO:
-- 25 años, trabaja en startup
-- Intereses: ciencia, deporte (juega fútbol semanal)
-- Tiene novia (vida social activa)
-- Quiere emprender y generar más dinero
-- Está construyendo su futuro financiero
-
-TU FILOSOFÍA:
-1. **Sé REALISTA, no dogmático**: Entiende que hay gastos necesarios y razonables (agua después de ejercicio, comida básica, vida social sana). NO regañes por estos.
-
-2. **Sé INTELIGENTE con las críticas**: 
-   - ✅ NO regañes por: agua/comida básica, gastos pequeños razonables, necesidades de salud/deporte
-   - ❌ SÍ regaña por: gastos excesivos sin sentido (ej: 400k en trago sin razón), gastos impulsivos grandes, decisiones financieras claramente malas
-
-3. **Equilibra VIDA SOCIAL con DISCIPLINA**:
-   - 30k con amigos: "Está bien, pero no lo hagas seguido. No más trago/salidas este mes hasta que te recuperes del presupuesto"
-   - Reconoce que la vida social es importante, pero establece límites realistas
+    if action == "income":
+        lines = [f"✅ Ingreso registrado: {_fmt_cop(amount)}" + (f" ({description})" if description else "")]
+        lines.append("Asígnalo a deuda y crecimiento antes de que se vaya en gastos.")
+        return "\n".join(lines)
 
-4. **Usa el HISTORIAL CONVERSACIONAL**:
-   - Recuerda compromisos anteriores ("Dijiste que no gastarías en X este mes")
-   - Da seguimiento a patrones ("Ya es la tercera vez este mes en...")
-   - Contextualiza tus respuestas basándote en conversaciones previas
+    if action == "check_budget":
+        lines = [f"📊 Presupuesto {category}:"]
+    else:
+        lines = [f"✅ Registrado: {_fmt_cop(amount)} en {category}" + (f" ({description})" if description else "")]
 
-5. **TONO CONVERSACIONAL y EDUCATIVO**:
-   - Habla como un amigo/mentor que entiende el contexto, no como un robot estricto
-   - Educa: explica POR QUÉ algo es problemático o está bien
-   - Motiva cuando haces bien las cosas
-   - Sé firme pero no agresivo cuando hay errores claros
+    if budget_status:
+        limit = float(budget_status.get('monthly_limit', 0) or 0)
+        remaining = float(budget_status.get('remaining', 0) or 0)
+        lines.append(f"Gastado: {_fmt_cop(limit - remaining)} de {_fmt_cop(limit)}")
+        lines.append(f"Restante: {_fmt_cop(remaining)}")
+        if remaining < 0:
+            lines.append("⚠️ Presupuesto excedido. Frena los gastos en esta categoría.")
+        elif action == "expense" and category in _CFO_TEMPLATE_TAILS:
+            lines.append(random.choice(_CFO_TEMPLATE_TAILS[category]))
+    return "\n".join(lines)
 
-PRESUPUESTOS:
-- fixed_survival ($1.714.300): Arriendo, servicios, seguridad social, cuota MÍNIMA icetex/lumni
-- debt_offensive ($412.850): Pagos EXTRA a deuda
-- kepler_growth ($412.850): Inversión en negocio/emprendimiento (AWS, APIs, Cursos)
-- networking_life ($309.000): Salidas estratégicas y ocio (equilibrado)
-- stupid_expenses: Gastos hormiga, lujos innecesarios
 
-REGLA DE ORO: Sé un COACH FINANCIERO realista que ayuda a construir riqueza sin perder la humanidad. La disciplina financiera debe servir para lograr objetivos, no para vivir infeliz."""
-    user_prompt = f"Transacción registrada:\n- Acción: {action}\n- Monto: ${amount:,.0f} COP\n- Categoría: {category}\n- Descripción: {description}"
+async def stream_cfo_response(
+    action: str,
+    amount: float,
+    category: Optional[str],
+    description: str,
+    budget_status: Optional[Dict[str, Any]] = None,
+    conversation_history: Optional[list] = None
+) -> AsyncIterator[str]:
+    """
+    Genera la respuesta de texto del CFO (Personalidad: Realista, Contextual y Educativa),
+    entregada por fragmentos a medida que llega de OpenAI.
+    Solo gasta tokens en gastos donde la personalidad importa: stupid_expenses o
+    gastos que pesan (>=10% del límite o presupuesto por debajo del 20%) fuera de
+    fixed_survival. El resto usa plantilla.
+    """
+    template = _cfo_template_response(action, amount, category, description, budget_status)
+    needs_llm = action == "expense" and (
+        category == "stupid_expenses" or (
+            budget_status
+            and category != "fixed_survival"
+            and not _is_low_stakes_expense(amount, budget_status)
+        )
+    )
+    if not needs_llm:
+        yield template
+        return
+
+    parts = [
+        "Transacción registrada:",
+        f"- Acción: {action}",
+        f"- Monto: {_fmt_cop(amount)}",
+        f"- Categoría: {category}",
+        f"- Descripción: {description}",
+    ]
     if budget_status:
         remaining = budget_status.get('remaining', 0)
         limit = budget_status.get('monthly_limit', 0)
-        user_prompt += f"\n\nEstado del presupuesto:\n- Límite mensual: ${limit:,.0f} COP\n- Gastado: ${limit - remaining:,.0f} COP\n- Restante: ${remaining:,.0f} COP"
+        parts.append(f"B:{limit:.0f}|S:{limit - remaining:.0f}|R:{remaining:.0f}")
         if remaining < 0:
-            user_prompt += "\n⚠️ Presupuesto excedido"
+            parts.append("⚠️ Presupuesto excedido")
+    user_prompt = "\n".join(parts)
+
+    async for chunk in _stream_completion(
+        template,
+        model="gpt-4o-mini",
+        messages=_build_messages(_CFO_SYS_MSG, conversation_history, user_prompt),
+        max_tokens=150,
+        temperature=0.7
+    ):
+        yield chunk
 
-    try:
-        client = get_openai_client()
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Agregar historial conversacional si existe
-        if conversation_history:
-            for msg in conversation_history:
-                msg_role = msg.get('role', 'user')
-                msg_content = msg.get('message', '')
-                if msg_role in ['user', 'assistant'] and msg_content:
-                    messages.append({"role": msg_role, "content": msg_content})
-        
-        # Agregar el mensaje actual
-        messages.append({"role": "user", "content": user_prompt})
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=250,
-            temperature=0.7
-        )
-        return response.choices[0].message.content.strip()
-    except Exception:
-        return "Transacción registrada."
 
-def generate_transaction_query_response(user_query: str, transactions: list, conversation_history: Optional[list] = None) -> str:
+async def generate_cfo_response(
+    action: str,
+    amount: float,
+    category: Optional[str],
+    description: str,
+    budget_status: Optional[Dict[str, Any]] = None,
+    conversation_history: Optional[list] = None
+) -> str:
+    """Igual que stream_cfo_response, pero devuelve el texto completo."""
+    chunks = [c async for c in stream_cfo_response(action, amount, category, description, budget_status, conversation_history)]
+    return "".join(chunks).strip()
+
+_TX_QUERY_SYSTEM_PROMPT = f"""Eres "Kepler CFO", su asistente financiero personal.
+{_USER_PROFILE}
+
+- Responde claro y conversacional sobre sus transacciones pasadas.
+- Usa el historial para contextualizar.
+- Si no hay coincidencias, dilo claramente.
+- Señala patrones si son relevantes ("Gastaste X en esto varias veces")."""
+_TX_QUERY_SYS_MSG = {"role": "system", "content": _TX_QUERY_SYSTEM_PROMPT}
+
+async def generate_transaction_query_response(user_query: str, transactions: list, conversation_history: Optional[list] = None) -> str:
     """
     Genera respuesta del CFO cuando el usuario consulta sobre transacciones pasadas.
     """
-    system_prompt = """Eres "Kepler CFO", el asistente financiero personal de un joven de 25 años que trabaja en una startup, le gusta la ciencia y el deporte, juega fútbol 1 vez por semana, tiene novia, está empezando a ganar bien y quiere emprender para generar más dinero.
-
-TU CONTEXTO DEL USUARIO:
-- 25 años, trabaja en startup
-- Intereses: ciencia, deporte (juega fútbol semanal)
-- Tiene novia (vida social activa)
-- Quiere emprender y generar más dinero
-- Está construyendo su futuro financiero
-
-TU FILOSOFÍA:
-- Sé REALISTA y CONVERSACIONAL: Responde preguntas sobre transacciones de forma clara y útil
-- Usa el historial conversacional para contextualizar
-- Presenta la información de forma organizada pero natural
-- Si no hay transacciones que coincidan, explica claramente
-- Analiza patrones si es relevante ("Veo que gastaste X en esto varias veces")
-
-TONO: Natural, conversacional, útil. Como un asistente financiero que entiende el contexto."""
     
     # Formatear transacciones para el prompt
     if not transactions:
         transactions_text = "No se encontraron transacciones que coincidan con la búsqueda."
     else:
-        transactions_text = f"Transacciones encontradas ({len(transactions)}):\n"
+        parts = [f"Transacciones encontradas ({len(transactions)}):"]
         for t in transactions[:20]:  # Limitar a 20 para no sobrecargar
-            amount = float(t.get("amount", 0) or 0)
             cat = t.get("category", "N/A")
             desc = t.get("description", "Sin descripción")
             trans_type = t.get("type", "expense")
             created_at = t.get("created_at", "")
             date_str = created_at.split("T")[0] if created_at else "Fecha desconocida"
-            transactions_text += f"- ${amount:,.0f} COP ({trans_type}) - {cat} - {desc} - {date_str}\n"
+            parts.append(f"- {_fmt_cop(t.get('amount'))} ({trans_type}) - {cat} - {desc} - {date_str}")
         if len(transactions) > 20:
-            transactions_text += f"\n... y {len(transactions) - 20} transacciones más"
+            parts.append(f"\n... y {len(transactions) - 20} transacciones más")
+        transactions_text = "\n".join(parts)
     
     user_prompt = f"Consulta del usuario: {user_query}\n\n{transactions_text}"
     
     try:
-        client = get_openai_client()
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Agregar historial conversacional si existe
-        if conversation_history:
-            for msg in conversation_history:
-                msg_role = msg.get('role', 'user')
-                msg_content = msg.get('message', '')
-                if msg_role in ['user', 'assistant'] and msg_content:
-                    messages.append({"role": msg_role, "content": msg_content})
-        
-        # Agregar el mensaje actual
-        messages.append({"role": "user", "content": user_prompt})
-        
-        response = client.chat.completions.create(
+        messages = _build_messages(_TX_QUERY_SYS_MSG, conversation_history, user_prompt)
+        response = await _chat_completion(
             model="gpt-4o-mini",
             messages=messages,
             max_tokens=400,
@@ -396,59 +780,74 @@ TONO: Natural, conversacional, útil. Como un asistente financiero que entiende
             # Fallback: mostrar transacciones de forma simple
             summary = f"Encontré {len(transactions)} transacciones:\n"
             total = sum(float(t.get("amount", 0) or 0) for t in transactions)
-            summary += f"Total: ${total:,.0f} COP"
+            summary += f"Total: {_fmt_cop(total)}"
             return summary
         return "No se encontraron transacciones que coincidan con tu búsqueda."
 
-def generate_spending_advice(user_query: str, amount: float, financial_state: Dict[str, Any], conversation_history: Optional[list] = None) -> str:
-    """
-    Coach financiero para compras futuras.
-    Filtros: Naval (Estatus vs Riqueza) y Manson (Esencialismo).
-    """
-    system_prompt = """Eres el Guardián Financiero.
-Analiza si el usuario debe comprar esto basándote en:
+_SPENDING_SYSTEM_PROMPT = """Eres el Guardián Financiero. Evalúa la compra:
 1. ¿Es deuda mala? (Naval)
 2. ¿Es para impresionar a gente que no le importa? (Manson)
 3. ¿Hay flujo de caja real? (CFO)
+Sé duro: tiene deudas y un emprendimiento que financiar. Máximo 5 líneas."""
+_SPENDING_SYS_MSG = {"role": "system", "content": _SPENDING_SYSTEM_PROMPT}
+
+_ADVICE_CACHE = TTLCache(maxsize=512, ttl=300)
+
+
+def _advice_cache_key(user_query: str, amount: float, financial_state: Dict[str, Any]) -> tuple:
+    """(consulta normalizada, monto en miles, hash del estado financiero)."""
+    query = _normalize_text(user_query)
+    state = orjson.dumps(financial_state, option=orjson.OPT_SORT_KEYS, default=str)
+    return (query, int((amount or 0) // 1000), hashlib.blake2b(state, digest_size=16).digest())
+
+
+async def stream_spending_advice(user_query: str, amount: float, financial_state: Dict[str, Any], conversation_history: Optional[list] = None) -> AsyncIterator[str]:
+    """
+    Coach financiero para compras futuras, entregado por fragmentos.
+    Filtros: Naval (Estatus vs Riqueza) y Manson (Esencialismo).
+    Misma consulta + mismo monto (por miles) + mismo estado financiero -> respuesta cacheada 5 min.
+    """
+    cache_key = _advice_cache_key(user_query, amount, financial_state)
+    cached = _ADVICE_CACHE.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
 
-Sé duro. El usuario tiene deudas y un emprendimiento que financiar.
-"""
     # Construcción de contexto financiero simplificado
-    context = f"Consulta: {user_query}. Monto: {amount}. Deuda Total: {financial_state.get('total_debt',0)}"
-    try:
-        client = get_openai_client()
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Agregar historial conversacional si existe
-        if conversation_history:
-            for msg in conversation_history:
-                msg_role = msg.get('role', 'user')
-                msg_content = msg.get('message', '')
-                if msg_role in ['user', 'assistant'] and msg_content:
-                    messages.append({"role": msg_role, "content": msg_content})
-        
-        # Agregar el mensaje actual
-        messages.append({"role": "user", "content": context})
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7
-        )
-        return response.choices[0].message.content.strip()
-    except Exception:
-        return "Si no genera dinero, no lo compres."
+    parts = [
+        f"Consulta: {user_query}",
+        f"Monto: {_fmt_cop(amount)}",
+        f"Deuda Total: {_fmt_cop(financial_state.get('total_debt', 0))}",
+    ]
+    budgets = financial_state.get("budgets") or {}
+    if budgets:
+        parts.append("Disponible por categoría:")
+        parts.extend(f"- {cat}: {_fmt_cop(b.get('remaining'))}" for cat, b in budgets.items())
+    patrimony = financial_state.get("patrimony") or {}
+    if patrimony:
+        parts.append(f"Patrimonio: {_fmt_cop(patrimony.get('current_balance'))} (queda este mes: {_fmt_cop(patrimony.get('remaining_this_month'))})")
+    context = "\n".join(parts)
+    async for chunk in _stream_completion(
+        "Si no genera dinero, no lo compres.",
+        on_complete=lambda text: _ADVICE_CACHE.set(cache_key, text),
+        model="gpt-4o-mini",
+        messages=_build_messages(_SPENDING_SYS_MSG, conversation_history, context),
+        max_tokens=200,
+        temperature=0.7
+    ):
+        yield chunk
+
+
+async def generate_spending_advice(user_query: str, amount: float, financial_state: Dict[str, Any], conversation_history: Optional[list] = None) -> str:
+    """Igual que stream_spending_advice, pero devuelve el texto completo."""
+    chunks = [c async for c in stream_spending_advice(user_query, amount, financial_state, conversation_history)]
+    return "".join(chunks).strip()
 
 # =============================================================================
 # CAPA 2B: EL MENTOR (Mentorship Layer)
 # =============================================================================
 
-def generate_mentorship_advice(user_message: str, conversation_history: Optional[list] = None) -> str:
-    """
-    LAYER 2B: The Mentor.
-    Responde como un amigo cercano: memoria, emociones, preguntas, lógica. Nada de bloques de texto robóticos.
-    """
-    system_prompt = """Eres el mentor y amigo de Andrés, 25 años, trabaja en startup, le gusta ciencia y deporte, fútbol semanal, novia, quiere emprender.
+_MENTOR_SYSTEM_PROMPT = """Eres el mentor y amigo de Andrés, 25 años, trabaja en startup, le gusta ciencia y deporte, fútbol semanal, novia, quiere emprender.
 
 REGLA #1: SI NO ENTIENDES, PREGUNTA.
 Si el mensaje es vago ("estoy mal", "no sé qué hacer", "ayuda"), NO des consejos genéricos. Pregunta:
@@ -481,44 +880,37 @@ FILOSOFÍA (de fondo, sin citar como robot): Dweck (mentalidad de crecimiento),
 
 NO menciones dinero, presupuestos ni deudas (eso es el CFO).
 """
-    try:
-        client = get_openai_client()
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        if conversation_history:
-            for msg in conversation_history:
-                msg_role = msg.get('role', 'user')
-                msg_content = msg.get('message', '')
-                if msg_role in ['user', 'assistant'] and msg_content:
-                    messages.append({"role": msg_role, "content": msg_content})
-        
-        messages.append({"role": "user", "content": user_message})
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.8,
-            max_tokens=350
-        )
-        return response.choices[0].message.content.strip()
-    except Exception:
-        return "No te sigo del todo. ¿Qué está pasando exactamente?"
+_MENTOR_SYS_MSG = {"role": "system", "content": _MENTOR_SYSTEM_PROMPT}
+
+# gpt-4o-mini por defecto (~10x más barato y más rápido); MENTOR_MODEL=gpt-4o para volver
+MENTOR_MODEL = os.getenv("MENTOR_MODEL", "gpt-4o-mini")
+
+async def stream_mentorship_advice(user_message: str, conversation_history: Optional[list] = None) -> AsyncIterator[str]:
+    """
+    LAYER 2B: The Mentor.
+    Responde como un amigo cercano: memoria, emociones, preguntas, lógica. Nada de bloques de texto robóticos.
+    Entrega la respuesta por fragmentos para que Telegram la muestre mientras se genera.
+    """
+    async for chunk in _stream_completion(
+        "No te sigo del todo. ¿Qué está pasando exactamente?",
+        model=MENTOR_MODEL,
+        messages=_build_messages(_MENTOR_SYS_MSG, conversation_history, user_message),
+        temperature=0.8,
+        max_tokens=350
+    ):
+        yield chunk
+
+
+async def generate_mentorship_advice(user_message: str, conversation_history: Optional[list] = None) -> str:
+    """Igual que stream_mentorship_advice, pero devuelve el texto completo."""
+    chunks = [c async for c in stream_mentorship_advice(user_message, conversation_history)]
+    return "".join(chunks).strip()
 
 # =============================================================================
 # CAPA 2C: EL AGENTE OPERATIVO (Operational / Schedule Layer)
 # =============================================================================
 
-def generate_operational_response(
-    user_message: str,
-    conversation_history: Optional[list] = None,
-    thoughts_context: Optional[list] = None
-) -> str:
-    """
-    LAYER 2C: Kepler Life Coach - Gestión del tiempo, plan semanal, reorganización.
-    Estricto con lo innegociable, flexible pero firme con el resto.
-    Entiende emociones y decisiones. Humanos no siempre cumplen al pie de la letra.
-    """
-    system_prompt = """Eres el Agente Operativo de Kepler. Tu misión es gestionar el plan semanal, recordar la estructura, ayudar a reorganizar cuando algo cambia, y ser estricto pero humano.
+_OPERATIONAL_SYSTEM_PROMPT = """Eres el Agente Operativo de Kepler. Tu misión es gestionar el plan semanal, recordar la estructura, ayudar a reorganizar cuando algo cambia, y ser estricto pero humano.
 
 ## TU ACTITUD
 - **Innegociables**: MEGA ESTRICTO. Si se pierde, lo marcas claro y ayudas a recuperar. Sin culpa innecesaria, pero firme.
@@ -566,6 +958,18 @@ def generate_operational_response(
 - **Áreas de aprendizaje**: Cuando menciones o recomiendes en qué estudiar, NUNCA uses "etc". Lista siempre las cinco tal cual: Matemática, Ingeniería Aeroespacial, Desarrollo de software, Producción musical, Inglés. Según lo que el usuario diga (contexto, ánimo, tiempo disponible), sugiérele una de esas cinco.
 - Responde en español, directo, como un coach operativo que conoce al usuario y su vida.
 """
+_OPERATIONAL_SYS_MSG = {"role": "system", "content": _OPERATIONAL_SYSTEM_PROMPT}
+
+async def generate_operational_response(
+    user_message: str,
+    conversation_history: Optional[list] = None,
+    thoughts_context: Optional[list] = None
+) -> str:
+    """
+    LAYER 2C: Kepler Life Coach - Gestión del tiempo, plan semanal, reorganización.
+    Estricto con lo innegociable, flexible pero firme con el resto.
+    Entiende emociones y decisiones. Humanos no siempre cumplen al pie de la letra.
+    """
     # Construir contexto adicional
     context_parts = []
     if thoughts_context and len(thoughts_context) > 0:
@@ -587,19 +991,8 @@ def generate_operational_response(
         user_prompt = f"{user_message}{context_str}"
     
     try:
-        client = get_openai_client()
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        if conversation_history:
-            for msg in conversation_history:
-                msg_role = msg.get('role', 'user')
-                msg_content = msg.get('message', '')
-                if msg_role in ['user', 'assistant'] and msg_content:
-                    messages.append({"role": msg_role, "content": msg_content})
-        
-        messages.append({"role": "user", "content": user_prompt})
-        
-        response = client.chat.completions.create(
+        messages = _build_messages(_OPERATIONAL_SYS_MSG, conversation_history, user_prompt)
+        response = await _chat_completion(
             model="gpt-4o",
             messages=messages,
             temperature=0.7,
@@ -622,24 +1015,24 @@ COPIA ESTA LÓGICA EN TU ARCHIVO PRINCIPAL (donde recibes el mensaje de Telegram
 user_text = update.message.text
 
 # 2. CAPA 1: ROUTER
-intencion = analyze_intent(user_text) # Devuelve "FINANCE" o "MENTORSHIP"
+intencion = await analyze_intent(user_text) # Devuelve "FINANCE" o "MENTORSHIP"
 
 response_text = ""
 
 if intencion == "MENTORSHIP":
     # 3. CAMINO A: MENTORÍA
     # Aquí puedes pasar un string con un resumen del estado actual si lo tienes
-    response_text = generate_mentorship_advice(user_text, "Deuda alta, Presupuesto ajustado")
+    response_text = await generate_mentorship_advice(user_text, "Deuda alta, Presupuesto ajustado")
 
 else:
     # 3. CAMINO B: FINANZAS (CFO)
-    decision = classify_financial_action(user_text)
+    decision = await classify_financial_action(user_text)
     action = decision.get("action")
     
     if action == "consult_spending":
         # Sub-camino: Coach de gastos
         # Necesitas pasar el estado financiero real aquí (financial_state)
-        response_text = generate_spending_advice(decision.get("description"), decision.get("amount"), financial_state)
+        response_text = await generate_spending_advice(decision.get("description"), decision.get("amount"), financial_state)
         
     elif action == "unknown":
         response_text = "No entendí. Si es dinero, sé específico (ej: 'Gasté 20k'). Si es consejo, dime qué sientes."
@@ -651,7 +1044,7 @@ else:
         
         # Generar respuesta del CFO
         # budget_status debe venir de tu DB
-        response_text = generate_cfo_response(
+        response_text = await generate_cfo_response(
             action, 
             decision.get("amount"), 
             decision.get("category"), 
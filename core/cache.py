@@ -0,0 +1,85 @@
+"""
+Caché en memoria con expiración (TTL) para Kepler Agent.
+Vive por instancia: en Vercel cada worker caliente tiene la suya, sin coordinación.
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Diccionario acotado con expiración por entrada.
+    Al superar maxsize se descarta la entrada usada hace más tiempo (LRU).
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        self._loading.pop(key, None)
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        """Descarta (y deja de cargar) todas las claves que cumplan predicate."""
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+        for key in [k for k in self._loading if predicate(k)]:
+            del self._loading[key]
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Devuelve el valor cacheado o lo carga con loader().
+        Las llamadas concurrentes para la misma clave comparten una sola carga.
+        None no se cachea (ej. fila inexistente).
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._loading[key] = task
+            task.add_done_callback(lambda t: self._finish_load(key, t))
+        # shield: cancelar a un solo interesado no cancela la carga compartida
+        return await asyncio.shield(task)
+
+    def _finish_load(self, key: Hashable, task: asyncio.Future) -> None:
+        failed = task.cancelled() or task.exception() is not None
+        if self._loading.get(key) is not task:
+            # Invalidada mientras cargaba: no guardar un valor que puede ser viejo
+            return
+        del self._loading[key]
+        if not failed and task.result() is not None:
+            self.set(key, task.result())
+
+    def clear(self) -> None:
+        self._loading.clear()
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -4,17 +4,40 @@ Handles transactions and budget management.
 """
 import os
 import httpx
+import orjson
+import random
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+from collections import deque
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from functools import lru_cache
+from itertools import islice
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Awaitable, Mapping, TypedDict, Iterable
 from dotenv import load_dotenv
+from core.cache import TTLCache
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 multiplexa las llamadas concurrentes sobre una sola conexión (requiere h2)
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 # Initialize Supabase client using REST API directly
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
+KEPLER_TZ = os.getenv("KEPLER_TZ", "America/Bogota")
+# Resolved once at import; UTC when the zone cannot be loaded
+try:
+    KEPLER_TZINFO = ZoneInfo(KEPLER_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    KEPLER_TZINFO = timezone.utc
 
 if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables")
@@ -22,20 +45,140 @@ if not supabase_url or not supabase_key:
 # Remove trailing slash if present
 supabase_url = supabase_url.rstrip('/')
 
-# Headers para Supabase
-def get_supabase_headers() -> Dict[str, str]:
-    """Get headers for Supabase API requests."""
-    if not supabase_key:
-        raise ValueError("SUPABASE_KEY is not set")
-    return {
-        "apikey": supabase_key,
-        "Authorization": f"Bearer {supabase_key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation"
-    }
+# Headers para Supabase (armados una sola vez al importar, de solo lectura)
+_SUPABASE_HEADERS: Mapping[str, str] = MappingProxyType({
+    "apikey": supabase_key,
+    "Authorization": f"Bearer {supabase_key}",
+    "Content-Type": "application/json",
+    "Prefer": "return=representation"
+})
+
+
+def get_supabase_headers() -> Mapping[str, str]:
+    """Get headers for Supabase API requests (read-only, built once at import)."""
+    return _SUPABASE_HEADERS
+
+
+# Writes whose response body is never read: PostgREST answers 201/204 with no body
+_PREFER_MINIMAL = MappingProxyType({"Prefer": "return=minimal"})
+
+# Counts only: PostgREST reports the total in Content-Range
+_PREFER_COUNT_EXACT = MappingProxyType({"Prefer": "count=exact"})
+
+# PostgREST table paths (relative to the pooled client's base_url)
+_TRANSACTIONS_URL = "/transactions"
+_BUDGETS_URL = "/budgets"
+_DEBTS_URL = "/debts"
+_PATRIMONY_URL = "/patrimony"
+_HISTORY_URL = "/conversation_history"
+_THOUGHTS_URL = "/thoughts_reminders"
+_SCHEDULE_URL = "/schedule_reminders"
+
+
+def _utc_iso(moment: datetime) -> str:
+    """Format an aware datetime as a UTC PostgREST timestamp ('...Z')."""
+    return moment.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
 
 
-async def insert_transaction(amount: float, category: str, description: str, transaction_type: str = "expense") -> Dict[str, Any]:
+@lru_cache(maxsize=1)
+def _month_start_iso(year: int, month: int) -> str:
+    return _utc_iso(datetime(year, month, 1, tzinfo=timezone.utc))
+
+
+def current_month_start_iso() -> str:
+    """First instant of the current UTC month as a PostgREST timestamp ('YYYY-MM-01T00:00:00Z')."""
+    now = datetime.now(timezone.utc)
+    return _month_start_iso(now.year, now.month)
+
+# Reintentos ante fallos transitorios de red / Supabase (502, 503, 504)
+RETRY_ATTEMPTS = 3
+_RETRYABLE_STATUS = {502, 503, 504}
+
+
+class _RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that retries transient failures with jittered exponential backoff.
+    Connection errors are retried for every method (the request never left);
+    read timeouts and 5xx only for GET, so inserts and RPC increments never run twice.
+    """
+
+    def __init__(self, **kwargs):
+        self._transport = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        idempotent = request.method in ("GET", "HEAD")
+        for attempt in range(RETRY_ATTEMPTS):
+            last_attempt = attempt == RETRY_ATTEMPTS - 1
+            try:
+                response = await self._transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if last_attempt:
+                    raise
+            except httpx.ReadTimeout:
+                if last_attempt or not idempotent:
+                    raise
+            else:
+                if last_attempt or not idempotent or response.status_code not in _RETRYABLE_STATUS:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 8) * (0.5 + random.random()))
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+# Cliente HTTP compartido: reutiliza conexiones TCP/TLS con Supabase entre llamadas
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Get or create the pooled httpx client for the Supabase REST API."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            base_url=f"{supabase_url}/rest/v1",
+            headers=_SUPABASE_HEADERS,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            transport=_RetryTransport(
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60.0),
+            ),
+        )
+    return _async_client
+
+
+async def close_async_client() -> None:
+    """Close the pooled Supabase client (call on application shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _first_row(response: httpx.Response) -> Any:
+    """Parse a PostgREST body and unwrap the first row (reads and writes answer with an array)."""
+    result = orjson.loads(response.content)
+    return result[0] if isinstance(result, list) and result else result
+
+
+async def _write(method: str, url: str, data: Any, params: Optional[Dict[str, str]] = None) -> None:
+    """
+    Send a write whose result the caller does not need: return=minimal, so
+    PostgREST answers with an empty body and nothing is parsed.
+    Raises httpx.HTTPStatusError on error responses.
+    """
+    client = get_async_client()
+    response = await client.request(method, url, params=params, content=orjson.dumps(data), headers=_PREFER_MINIMAL)
+    response.raise_for_status()
+
+
+def _rows(response: httpx.Response) -> list[Dict[str, Any]]:
+    """Parse a PostgREST body as a list of rows ([] for anything else)."""
+    result = orjson.loads(response.content)
+    return result if isinstance(result, list) else []
+
+
+async def insert_transaction(amount: float, category: str, description: str, transaction_type: str = "expense") -> None:
     """
     Insert a new transaction into the database.
     
@@ -46,7 +189,7 @@ async def insert_transaction(amount: float, category: str, description: str, tra
         transaction_type: Type of transaction - "expense" or "income" (default: "expense")
         
     Returns:
-        Dict with transaction data
+        None (the row is not echoed back, callers only need the write to succeed)
     """
     try:
         data = {
@@ -56,31 +199,28 @@ async def insert_transaction(amount: float, category: str, description: str, tra
             "type": transaction_type
         }
         
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/transactions"
+        url = _TRANSACTIONS_URL
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=data, headers=headers)
-            
-            # Log error details for debugging
-            if response.status_code != 201:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    error_detail = str(error_json)
-                except:
-                    pass
-                logger.error(f"Supabase error {response.status_code}: {error_detail}. Headers sent: {list(headers.keys())}")
-                raise Exception(f"Supabase error {response.status_code}: {error_detail}. Request data: {data}")
-            
-            result = response.json()
-            # Supabase returns array, get first element
-            return result[0] if isinstance(result, list) and result else result
+        client = get_async_client()
+        response = await client.post(url, content=orjson.dumps(data), headers=_PREFER_MINIMAL)
+
+        # Log error details for debugging
+        if response.status_code != 201:
+            error_detail = response.text
+            logger.error(f"Supabase error {response.status_code}: {error_detail}. Headers sent: {list(client.headers.keys())}")
+            raise Exception(f"Supabase error {response.status_code}: {error_detail}. Request data: {data}")
     except httpx.HTTPStatusError as e:
         error_detail = e.response.text if e.response else str(e)
-        raise Exception(f"Error inserting transaction (HTTP {e.response.status_code if e.response else 'unknown'}): {error_detail}")
+        raise Exception(f"Error inserting transaction (HTTP {e.response.status_code if e.response else 'unknown'}): {error_detail}") from e
     except Exception as e:
-        raise Exception(f"Error inserting transaction: {str(e)}")
+        raise Exception(f"Error inserting transaction: {str(e)}") from e
+
+
+def _escape_like(text: str) -> str:
+    """Make user text match literally inside a PostgREST ilike pattern."""
+    # * is PostgREST's wildcard; % and _ are LIKE's own, escaped with backslash
+    text = text.replace("*", "")
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 
 async def get_transactions(
@@ -104,11 +244,9 @@ async def get_transactions(
         List of transaction dictionaries
     """
     try:
-        from datetime import datetime, timedelta
-        
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/transactions"
+        url = _TRANSACTIONS_URL
         params = {
+            "select": _TRANSACTION_SELECT,
             "order": "created_at.desc",
             "limit": str(limit)
         }
@@ -118,32 +256,80 @@ async def get_transactions(
             params["category"] = f"eq.{category}"
         if transaction_type:
             params["type"] = f"eq.{transaction_type}"
+        if description:
+            # Case-insensitive substring match done by Postgres
+            params["description"] = f"ilike.*{_escape_like(description)}*"
         if days:
-            date_filter = (datetime.now() - timedelta(days=days)).isoformat() + "Z"
+            date_filter = _utc_iso(datetime.now(timezone.utc) - timedelta(days=days))
             params["created_at"] = f"gte.{date_filter}"
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            
-            transactions = result if isinstance(result, list) else []
-            
-            # Filter by description if provided (Supabase text search is limited, so we filter in Python)
-            if description:
-                desc_lower = description.lower()
-                transactions = [
-                    t for t in transactions 
-                    if t.get("description") and desc_lower in t.get("description", "").lower()
-                ]
-            
-            return transactions
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        return _rows(response)
     except Exception as e:
         logger.error(f"Error getting transactions: {str(e)}")
         return []
 
 
-async def get_budget(category: str) -> Optional[Dict[str, Any]]:
+class BudgetRow(TypedDict, total=False):
+    category: str
+    monthly_limit: float
+    current_spent: float
+
+
+class DebtRow(TypedDict, total=False):
+    id: str
+    name: str
+    initial_balance: float
+    current_balance: float
+    minimum_payment: float
+
+
+class PatrimonyRow(TypedDict, total=False):
+    id: str
+    initial_balance: float
+    current_balance: float
+    last_month_income: float
+    last_month_expenses: float
+
+
+# Columns actually read by the app (PostgREST select=); keeps payloads small
+_TRANSACTION_SELECT = "amount,category,description,type,created_at"
+_BUDGET_SELECT = "category,monthly_limit,current_spent"
+_DEBT_SELECT = "name,initial_balance,current_balance,minimum_payment"
+_PATRIMONY_SELECT = "id,initial_balance,current_balance,last_month_income,last_month_expenses"
+_THOUGHT_SELECT = "id,chat_id,type,content,created_at,reminder_date,is_completed"
+
+_BUDGET_NUMERIC = ("monthly_limit", "current_spent")
+_DEBT_NUMERIC = ("initial_balance", "current_balance", "minimum_payment")
+_PATRIMONY_NUMERIC = ("initial_balance", "current_balance", "last_month_income", "last_month_expenses")
+
+
+def _coerce_numeric(row: Dict[str, Any], fields: Iterable[str]) -> Dict[str, Any]:
+    """Parse PostgREST numeric columns (null/str/int) to float once, when the row is loaded."""
+    for field in fields:
+        if field in row:
+            row[field] = float(row[field] or 0)
+    return row
+
+
+BUDGET_CATEGORIES = ("fixed_survival", "debt_offensive", "kepler_growth", "networking_life", "stupid_expenses")
+
+# Budget rows only change through this module, so reads are cached briefly and
+# refreshed/invalidated on our own writes.
+_BUDGET_CACHE = TTLCache(maxsize=16, ttl=60)
+
+
+def invalidate_budget(category: Optional[str] = None) -> None:
+    """Drop the cached budget row for a category (or all of them if None)."""
+    if category is None:
+        _BUDGET_CACHE.clear()
+    else:
+        _BUDGET_CACHE.pop(category)
+
+
+async def get_budget(category: str) -> Optional[BudgetRow]:
     """
     Get budget information for a specific category.
     
@@ -153,26 +339,80 @@ async def get_budget(category: str) -> Optional[Dict[str, Any]]:
     Returns:
         Dict with budget data or None if not found
     """
+    # Concurrent misses for the same category share one request
+    return await _BUDGET_CACHE.get_or_load(category, lambda: _fetch_budget(category))
+
+
+async def _fetch_budget(category: str) -> Optional[BudgetRow]:
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/budgets"
-        params = {"category": f"eq.{category}"}
+        url = _BUDGETS_URL
+        params = {"category": f"eq.{category}", "select": _BUDGET_SELECT}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        row = _first_row(response)
+        return _coerce_numeric(row, _BUDGET_NUMERIC) if row else None
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting budget: {str(e)}") from e
+
+
+async def get_budgets_bulk(categories=BUDGET_CATEGORIES, fresh: bool = False) -> Dict[str, BudgetRow]:
+    """
+    Get several budget rows in one request (category=in.(...)).
+    
+    Args:
+        categories: Budget categories to fetch
+        fresh: Ignore cached rows and read every category from Supabase
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0]
-            return None
-    except Exception as e:
-        raise Exception(f"Error getting budget: {str(e)}")
+    Returns:
+        Dict mapping category -> budget data (missing categories are omitted)
+    """
+    if fresh:
+        return await _fetch_budgets(categories)
+    bulk: Optional[asyncio.Future] = None
+
+    def load(category: str) -> Awaitable[Optional[BudgetRow]]:
+        # All misses share one GET; a category already loading (get_budget or
+        # another bulk call) joins that load instead.
+        nonlocal bulk
+        if bulk is None:
+            bulk = asyncio.ensure_future(_fetch_budgets(categories))
+
+        async def pick() -> Optional[BudgetRow]:
+            return (await asyncio.shield(bulk)).get(category)
+        return pick()
+
+    rows = await asyncio.gather(
+        *(_BUDGET_CACHE.get_or_load(cat, lambda cat=cat: load(cat)) for cat in categories)
+    )
+    return {cat: row for cat, row in zip(categories, rows) if row is not None}
+
+
+async def _fetch_budgets(categories) -> Dict[str, BudgetRow]:
+    try:
+        url = _BUDGETS_URL
+        params = {
+            "category": f"in.({','.join(categories)})",
+            "select": _BUDGET_SELECT
+        }
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        budgets = {}
+        for row in _rows(response):
+            _coerce_numeric(row, _BUDGET_NUMERIC)
+            budgets[row["category"]] = row
+        return budgets
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting budgets: {str(e)}") from e
 
 
-async def update_budget_spent(category: str, amount: float) -> Dict[str, Any]:
+async def update_budget_spent(category: str, amount: float) -> BudgetRow:
     """
     Update the current_spent amount for a budget category.
-    This adds the amount to the existing current_spent.
+    This adds the amount to the existing current_spent atomically (one RPC call).
     
     Args:
         category: Budget category
@@ -182,28 +422,22 @@ async def update_budget_spent(category: str, amount: float) -> Dict[str, Any]:
         Updated budget data
     """
     try:
-        # First, get current budget
-        budget = await get_budget(category)
-        if not budget:
+        # Suma atómica en el servidor (ver database/rpc_functions.sql)
+        url = "/rpc/increment_budget_spent"
+        data = {"p_category": category, "p_amount": float(amount)}
+        
+        client = get_async_client()
+        response = await client.post(url, params={"select": _BUDGET_SELECT}, content=orjson.dumps(data))
+        response.raise_for_status()
+        result = _first_row(response)
+        if not result:
             raise Exception(f"Budget not found for category: {category}")
-        
-        current_spent = budget.get("current_spent", 0) or 0
-        new_spent = float(current_spent) + float(amount)
-        
-        # Update the budget using PATCH
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/budgets"
-        params = {"category": f"eq.{category}"}
-        data = {"current_spent": new_spent}
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.patch(url, params=params, json=data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            # Supabase returns array, get first element
-            return result[0] if isinstance(result, list) and result else result
+        _coerce_numeric(result, _BUDGET_NUMERIC)
+        _BUDGET_CACHE.set(category, result)
+        return result
     except Exception as e:
-        raise Exception(f"Error updating budget: {str(e)}")
+        invalidate_budget(category)
+        raise Exception(f"Error updating budget: {str(e)}") from e
 
 
 async def get_budget_status(category: str) -> Dict[str, Any]:
@@ -224,8 +458,8 @@ async def get_budget_status(category: str) -> Dict[str, Any]:
         if not budget:
             raise Exception(f"Budget not found for category: {category}")
         
-        monthly_limit = budget.get("monthly_limit", 0) or 0
-        current_spent = budget.get("current_spent", 0) or 0
+        monthly_limit = budget.get("monthly_limit", 0.0)
+        current_spent = budget.get("current_spent", 0.0)
         remaining = monthly_limit - current_spent
         
         return {
@@ -235,34 +469,84 @@ async def get_budget_status(category: str) -> Dict[str, Any]:
             "remaining": remaining
         }
     except Exception as e:
-        raise Exception(f"Error getting budget status: {str(e)}")
+        raise Exception(f"Error getting budget status: {str(e)}") from e
+
+
+async def register_expense(amount: float, category: str, description: str, transaction_type: str = "expense") -> Dict[str, Any]:
+    """
+    Register an expense in one round trip: inserts the transaction, adds it to the
+    budget and returns the updated budget status (see database/rpc_functions.sql).
+    
+    Args:
+        amount: Transaction amount in COP
+        category: Budget category
+        description: Transaction description
+        transaction_type: Type of transaction (default: "expense")
+        
+    Returns:
+        Dict with budget status including:
+        - monthly_limit
+        - current_spent
+        - remaining
+    """
+    try:
+        url = "/rpc/register_expense"
+        data = {
+            "p_amount": float(amount),
+            "p_category": category,
+            "p_description": description if description else None,
+            "p_type": transaction_type
+        }
+        
+        client = get_async_client()
+        response = await client.post(url, content=orjson.dumps(data))
+        response.raise_for_status()
+        status = _first_row(response)
+        if not status:
+            raise Exception(f"Budget not found for category: {category}")
+        return status
+    except httpx.HTTPStatusError as e:
+        raise Exception(f"Error registering expense (HTTP {e.response.status_code}): {e.response.text}") from e
+    except Exception as e:
+        raise Exception(f"Error registering expense: {str(e)}") from e
+    finally:
+        # The RPC returns a status, not the full row: drop the cached row instead
+        invalidate_budget(category)
 
 
 # ============================================
 # DEBT MANAGEMENT FUNCTIONS
 # ============================================
 
-async def get_all_debts() -> list[Dict[str, Any]]:
+# Debts only change through update_debt_balance, which drops this entry
+_DEBTS_CACHE = TTLCache(maxsize=1, ttl=60)
+
+
+async def get_all_debts() -> list[DebtRow]:
     """
     Get all debts (Lumni and ICETEX).
+    Served from an in-process cache for up to 60 seconds.
     
     Returns:
         List of debt dictionaries
     """
+    return await _DEBTS_CACHE.get_or_load("all", _fetch_all_debts)
+
+
+async def _fetch_all_debts() -> list[DebtRow]:
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/debts"
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            return result if isinstance(result, list) else []
-    except Exception as e:
-        raise Exception(f"Error getting debts: {str(e)}")
+        url = _DEBTS_URL
+        params = {"select": _DEBT_SELECT}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        return [_coerce_numeric(d, _DEBT_NUMERIC) for d in _rows(response)]
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting debts: {str(e)}") from e
 
 
-async def get_debt(debt_name: str) -> Optional[Dict[str, Any]]:
+async def get_debt(debt_name: str) -> Optional[DebtRow]:
     """
     Get a specific debt by name.
     
@@ -272,23 +556,23 @@ async def get_debt(debt_name: str) -> Optional[Dict[str, Any]]:
     Returns:
         Debt dictionary or None if not found
     """
+    cached = _DEBTS_CACHE.get("all")
+    if cached is not None:
+        return next((d for d in cached if d.get("name") == debt_name), None)
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/debts"
-        params = {"name": f"eq.{debt_name}"}
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0]
-            return None
-    except Exception as e:
-        raise Exception(f"Error getting debt: {str(e)}")
+        url = _DEBTS_URL
+        params = {"name": f"eq.{debt_name}", "select": _DEBT_SELECT}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        row = _first_row(response)
+        return _coerce_numeric(row, _DEBT_NUMERIC) if row else None
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting debt: {str(e)}") from e
 
 
-async def update_debt_balance(debt_name: str, payment_amount: float) -> Dict[str, Any]:
+async def update_debt_balance(debt_name: str, payment_amount: float) -> DebtRow:
     """
     Update debt balance by reducing it with a payment.
     This is called when there's a payment (monthly or extraordinary).
@@ -301,56 +585,64 @@ async def update_debt_balance(debt_name: str, payment_amount: float) -> Dict[str
         Updated debt dictionary
     """
     try:
-        # Get current debt
-        debt = await get_debt(debt_name)
-        if not debt:
-            raise Exception(f"Debt '{debt_name}' not found")
-        
-        current_balance = float(debt.get("current_balance", 0) or 0)
-        new_balance = max(0, current_balance - float(payment_amount))  # Don't go below 0
+        # Atomic server-side decrement, never below 0 (see database/rpc_functions.sql)
+        url = "/rpc/decrement_debt_balance"
+        data = {"p_name": debt_name, "p_payment": float(payment_amount)}
         
-        # Update the debt
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/debts"
-        params = {"name": f"eq.{debt_name}"}
-        data = {"current_balance": new_balance}
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.patch(url, params=params, json=data, headers=headers)
+        client = get_async_client()
+        try:
+            response = await client.post(url, params={"select": _DEBT_SELECT}, content=orjson.dumps(data))
             response.raise_for_status()
-            result = response.json()
-            return result[0] if isinstance(result, list) and result else result
+        finally:
+            _DEBTS_CACHE.clear()
+        result = _first_row(response)
+        if not result:
+            raise Exception(f"Debt '{debt_name}' not found")
+        return _coerce_numeric(result, _DEBT_NUMERIC)
     except Exception as e:
-        raise Exception(f"Error updating debt balance: {str(e)}")
+        raise Exception(f"Error updating debt balance: {str(e)}") from e
 
 
 # ============================================
 # PATRIMONY MANAGEMENT FUNCTIONS
 # ============================================
 
-async def get_patrimony() -> Optional[Dict[str, Any]]:
+# Single patrimony row; refreshed by update_patrimony_end_of_month
+_PATRIMONY_CACHE = TTLCache(maxsize=1, ttl=60)
+
+
+async def get_patrimony(fresh: bool = False) -> Optional[PatrimonyRow]:
     """
     Get current patrimony information.
+    Served from an in-process cache for up to 60 seconds.
+    
+    Args:
+        fresh: Skip the cache and read the row from Supabase (use before writing
+            money: another instance may have changed it within the TTL)
     
     Returns:
         Patrimony dictionary or None if not found
     """
+    if fresh:
+        return await _fetch_patrimony()
+    return await _PATRIMONY_CACHE.get_or_load("current", _fetch_patrimony)
+
+
+async def _fetch_patrimony() -> Optional[PatrimonyRow]:
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/patrimony"
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0]
-            return None
-    except Exception as e:
-        raise Exception(f"Error getting patrimony: {str(e)}")
+        url = _PATRIMONY_URL
+        params = {"select": _PATRIMONY_SELECT}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        row = _first_row(response)
+        return _coerce_numeric(row, _PATRIMONY_NUMERIC) if row else None
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting patrimony: {str(e)}") from e
 
 
-async def calculate_monthly_patrimony() -> Dict[str, Any]:
+async def calculate_monthly_patrimony(fresh: bool = False) -> Dict[str, Any]:
     """
     Calculate current month's patrimony status.
     This tracks in real-time: Ingreso mensual - Gastos totales = Lo que queda
@@ -358,6 +650,10 @@ async def calculate_monthly_patrimony() -> Dict[str, Any]:
     IMPORTANTE: Los gastos se calculan sumando current_spent de todos los budgets,
     no de las transacciones individuales, porque eso refleja mejor el gasto real.
     
+    Args:
+        fresh: Read patrimony and budgets from Supabase, skipping the 60s caches
+            (required when the result is written back, e.g. month close)
+    
     Returns:
         Dict with:
         - monthly_income: Total income this month
@@ -366,55 +662,53 @@ async def calculate_monthly_patrimony() -> Dict[str, Any]:
         - current_patrimony: Patrimony accumulated balance
     """
     try:
-        from datetime import datetime
-        
         # Get current month start in ISO format (Supabase REST API format)
-        now = datetime.now()
-        month_start = datetime(now.year, now.month, 1).isoformat() + "Z"
+        month_start = current_month_start_iso()
         
-        headers = get_supabase_headers()
         
-        # Get total income this month from transactions
-        income_url = f"{supabase_url}/rest/v1/transactions"
-        income_params = {
-            "type": "eq.income",
-            "created_at": f"gte.{month_start}"
-        }
+        # Total income this month, summed by Postgres (see database/rpc_functions.sql)
+        income_url = "/rpc/monthly_income"
+        income_data = {"p_start": month_start}
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Get income
-            income_response = await client.get(income_url, params=income_params, headers=headers)
-            income_response.raise_for_status()
-            income_transactions = income_response.json()
-            monthly_income = sum(float(t.get("amount", 0) or 0) for t in income_transactions) if isinstance(income_transactions, list) else 0
-            
-            # Get expenses from budgets (sum of all current_spent)
-            # Esto es más preciso porque refleja el gasto real por categoría
-            budget_categories = ["fixed_survival", "debt_offensive", "kepler_growth", "networking_life", "stupid_expenses"]
-            monthly_expenses = 0
-            for cat in budget_categories:
-                try:
-                    budget = await get_budget(cat)
-                    if budget:
-                        monthly_expenses += float(budget.get("current_spent", 0) or 0)
-                except:
-                    pass
-            
-            # Get current patrimony
-            patrimony = await get_patrimony()
-            current_patrimony = float(patrimony.get("current_balance", 0) or 0) if patrimony else 0
-            
-            remaining_this_month = monthly_income - monthly_expenses
-            
-            return {
-                "monthly_income": monthly_income,
-                "monthly_expenses": monthly_expenses,
-                "remaining_this_month": remaining_this_month,
-                "current_patrimony": current_patrimony,
-                "projected_patrimony": current_patrimony + remaining_this_month
-            }
+        client = get_async_client()
+        
+        # Income, budgets and patrimony are independent: fetch them concurrently
+        income_response, patrimony, budgets = await asyncio.gather(
+            client.post(income_url, content=orjson.dumps(income_data)),
+            get_patrimony(fresh=fresh),
+            get_budgets_bulk(fresh=fresh),
+            return_exceptions=True,
+        )
+        
+        # Get income
+        if isinstance(income_response, Exception):
+            raise income_response
+        income_response.raise_for_status()
+        monthly_income = float(orjson.loads(income_response.content) or 0)
+
+        # Get expenses from budgets (sum of all current_spent)
+        # Esto es más preciso porque refleja el gasto real por categoría
+        # Budgets that failed to load count as 0, as before
+        monthly_expenses = 0
+        if isinstance(budgets, dict):
+            monthly_expenses = sum(b.get("current_spent", 0.0) for b in budgets.values())
+
+        # Get current patrimony
+        if isinstance(patrimony, Exception):
+            raise patrimony
+        current_patrimony = patrimony.get("current_balance", 0.0) if patrimony else 0.0
+
+        remaining_this_month = monthly_income - monthly_expenses
+
+        return {
+            "monthly_income": monthly_income,
+            "monthly_expenses": monthly_expenses,
+            "remaining_this_month": remaining_this_month,
+            "current_patrimony": current_patrimony,
+            "projected_patrimony": current_patrimony + remaining_this_month
+        }
     except Exception as e:
-        raise Exception(f"Error calculating monthly patrimony: {str(e)}")
+        raise Exception(f"Error calculating monthly patrimony: {str(e)}") from e
 
 
 async def reset_all_budgets() -> bool:
@@ -426,25 +720,20 @@ async def reset_all_budgets() -> bool:
         True if successful, False otherwise
     """
     try:
-        # Update each budget category individually
-        budget_categories = ["fixed_survival", "debt_offensive", "kepler_growth", "networking_life", "stupid_expenses"]
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/budgets"
+        # One bulk PATCH for every category: a single round trip, and the
+        # reset is all-or-nothing in the database
+        url = _BUDGETS_URL
+        params = {"category": f"in.({','.join(BUDGET_CATEGORIES)})"}
+        data = {"current_spent": 0}
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            for category in budget_categories:
-                try:
-                    params = {"category": f"eq.{category}"}
-                    data = {"current_spent": 0}
-                    response = await client.patch(url, params=params, json=data, headers=headers)
-                    response.raise_for_status()
-                except Exception as e:
-                    logger.warning(f"Could not reset budget for {category}: {str(e)}")
-                    # Continue with other categories even if one fails
-            return True
+        try:
+            await _write("PATCH", url, data, params=params)
+        finally:
+            invalidate_budget()
+        return True
     except Exception as e:
         logger.error(f"Error resetting budgets: {str(e)}")
-        raise Exception(f"Error resetting budgets: {str(e)}")
+        raise Exception(f"Error resetting budgets: {str(e)}") from e
 
 
 async def get_complete_financial_state() -> Dict[str, Any]:
@@ -456,34 +745,47 @@ async def get_complete_financial_state() -> Dict[str, Any]:
         Dict with complete financial state
     """
     try:
+        month_start = current_month_start_iso()
+        
+        # One RPC returns budgets, debts, patrimony and the month's income
+        # (see database/rpc_functions.sql)
+        client = get_async_client()
+        response = await client.post("/rpc/financial_state", content=orjson.dumps({"p_start": month_start}))
+        response.raise_for_status()
+        state = orjson.loads(response.content) or {}
+        
+        # The RPC's projection is maintained separately from the *_SELECT columns,
+        # so its rows stay local and never feed the get_budget/get_all_debts caches
+        budgets = {
+            row["category"]: _coerce_numeric(row, _BUDGET_NUMERIC)
+            for row in state.get("budgets") or []
+        }
+        debts = [_coerce_numeric(d, _DEBT_NUMERIC) for d in state.get("debts") or []]
+        patrimony = state.get("patrimony")
+        if patrimony:
+            _coerce_numeric(patrimony, _PATRIMONY_NUMERIC)
+        
         # Get all budgets
-        budget_categories = ["fixed_survival", "debt_offensive", "kepler_growth", "networking_life", "stupid_expenses"]
         budgets_dict = {}
-        for cat in budget_categories:
-            try:
-                budget_status = await get_budget_status(cat)
-                budgets_dict[cat] = {
-                    "monthly_limit": budget_status.get("monthly_limit", 0),
-                    "current_spent": budget_status.get("current_spent", 0),
-                    "remaining": budget_status.get("remaining", 0)
-                }
-            except:
-                budgets_dict[cat] = {
-                    "monthly_limit": 0,
-                    "current_spent": 0,
-                    "remaining": 0
-                }
+        for cat in BUDGET_CATEGORIES:
+            budget = budgets.get(cat) or {}
+            monthly_limit = budget.get("monthly_limit", 0.0)
+            current_spent = budget.get("current_spent", 0.0)
+            budgets_dict[cat] = {
+                "monthly_limit": monthly_limit,
+                "current_spent": current_spent,
+                "remaining": monthly_limit - current_spent
+            }
         
-        # Get all debts
-        debts = await get_all_debts()
-        total_debt = sum(float(d.get("current_balance", 0) or 0) for d in debts)
+        # Get all debts (summed by the RPC)
+        total_debt = float(state.get("total_debt") or 0)
         
-        # Get patrimony
-        monthly_status = await calculate_monthly_patrimony()
-        patrimony_data = await get_patrimony()
+        # Get patrimony (expenses = sum of current_spent, as in calculate_monthly_patrimony)
+        monthly_income = float(state.get("monthly_income") or 0)
+        monthly_expenses = sum(b["current_spent"] for b in budgets_dict.values())
         patrimony_dict = {
-            "current_balance": float(patrimony_data.get("current_balance", 0) or 0) if patrimony_data else 0,
-            "remaining_this_month": monthly_status.get("remaining_this_month", 0)
+            "current_balance": patrimony.get("current_balance", 0.0) if patrimony else 0.0,
+            "remaining_this_month": monthly_income - monthly_expenses
         }
         
         return {
@@ -494,10 +796,10 @@ async def get_complete_financial_state() -> Dict[str, Any]:
         }
     except Exception as e:
         logger.error(f"Error getting complete financial state: {str(e)}")
-        raise Exception(f"Error getting complete financial state: {str(e)}")
+        raise Exception(f"Error getting complete financial state: {str(e)}") from e
 
 
-async def update_patrimony_end_of_month(remaining: Optional[float] = None) -> Dict[str, Any]:
+async def update_patrimony_end_of_month(remaining: Optional[float] = None) -> PatrimonyRow:
     """
     Update patrimony at the end of the month.
     Adds (or subtracts if negative) the remaining amount (income - expenses) to the accumulated patrimony.
@@ -511,52 +813,66 @@ async def update_patrimony_end_of_month(remaining: Optional[float] = None) -> Di
     """
     try:
         # Calculate what's left this month if not provided
+        # fresh: this writes money, so another instance's recent expenses must be visible
         if remaining is None:
-            monthly_status = await calculate_monthly_patrimony()
+            monthly_status = await calculate_monthly_patrimony(fresh=True)
             remaining = monthly_status.get("remaining_this_month", 0)
         else:
-            monthly_status = await calculate_monthly_patrimony()
+            monthly_status = await calculate_monthly_patrimony(fresh=True)
         
-        # Get current patrimony
-        patrimony = await get_patrimony()
+        # Get current patrimony (fresh: the new balance is written from it)
+        patrimony = await get_patrimony(fresh=True)
         if not patrimony:
             raise Exception("Patrimony record not found")
         
-        current_balance = float(patrimony.get("current_balance", 0) or 0)
+        current_balance = patrimony.get("current_balance", 0.0)
         # Add remaining (can be negative, which will subtract)
         new_balance = current_balance + remaining
         # Don't allow negative patrimony (or allow it, depending on business logic)
         # For now, we'll allow it to go negative if expenses exceed patrimony
         
         # Update patrimony using the ID from the patrimony record
-        headers = get_supabase_headers()
         patrimony_id = patrimony.get("id")
         if not patrimony_id:
             raise Exception("Patrimony record has no ID")
         
-        url = f"{supabase_url}/rest/v1/patrimony"
+        url = _PATRIMONY_URL
         # Use ID filter for PATCH (Supabase requires a filter for PATCH operations)
-        params = {"id": f"eq.{patrimony_id}"}
+        params = {"id": f"eq.{patrimony_id}", "select": _PATRIMONY_SELECT}
         data = {
             "current_balance": new_balance,
             "last_month_income": monthly_status.get("monthly_income", 0),
             "last_month_expenses": monthly_status.get("monthly_expenses", 0)
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.patch(url, params=params, json=data, headers=headers)
+        client = get_async_client()
+        try:
+            response = await client.patch(url, params=params, content=orjson.dumps(data))
             response.raise_for_status()
-            result = response.json()
-            return result[0] if isinstance(result, list) and result else result
+        finally:
+            _PATRIMONY_CACHE.clear()
+        updated = _first_row(response)
+        if isinstance(updated, dict) and updated.get("id"):
+            _PATRIMONY_CACHE.set("current", _coerce_numeric(updated, _PATRIMONY_NUMERIC))
+        return updated
     except Exception as e:
-        raise Exception(f"Error updating patrimony end of month: {str(e)}")
+        raise Exception(f"Error updating patrimony end of month: {str(e)}") from e
 
 
 # ============================================
 # CONVERSATION HISTORY FUNCTIONS
 # ============================================
 
-async def save_conversation_message(chat_id: int, role: str, message: str, intent: Optional[str] = None) -> Dict[str, Any]:
+# Recent messages per chat (oldest first), warmed from Supabase and then
+# appended on every save. The short TTL (counted from the load; appends do not
+# extend it) bounds staleness when another instance writes to the same chat,
+# while still covering the reads of one turn.
+_HISTORY_WINDOW = 30
+_HISTORY_PARAMS = MappingProxyType({"order": "created_at.desc", "limit": str(_HISTORY_WINDOW)})
+_HISTORY_CACHE = TTLCache(maxsize=256, ttl=15)
+
+
+async def save_conversation_message(chat_id: int, role: str, message: str, intent: Optional[str] = None) -> None:
     """
     Save a conversation message to the history.
     
@@ -567,26 +883,105 @@ async def save_conversation_message(chat_id: int, role: str, message: str, inten
         intent: Optional intent ('FINANCE' or 'MENTORSHIP')
         
     Returns:
-        Dict with saved message data
+        None (the row is not echoed back, callers only need the write to succeed)
+    """
+    await save_conversation_messages([_history_row(chat_id, role, message, intent)])
+
+
+def _history_row(chat_id: int, role: str, message: str, intent: Optional[str]) -> Dict[str, Any]:
+    # created_at is set here: rows inserted together would otherwise share the
+    # transaction's now() and lose their order
+    return {
+        "chat_id": chat_id,
+        "role": role,
+        "message": message,
+        "intent": intent,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def save_conversation_messages(rows: list[Dict[str, Any]]) -> None:
+    """
+    Insert several conversation rows in one request (PostgREST bulk insert).
+    
+    Args:
+        rows: Rows built with the same keys (chat_id, role, message, intent, created_at)
     """
     try:
-        data = {
-            "chat_id": chat_id,
-            "role": role,
-            "message": message,
-            "intent": intent
-        }
-        
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/conversation_history"
+        await _write("POST", _HISTORY_URL, rows)
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            return result[0] if isinstance(result, list) and result else result
+        for row in rows:
+            history = _HISTORY_CACHE.get(row["chat_id"])
+            if history is not None:
+                history.append(row)
     except Exception as e:
-        raise Exception(f"Error saving conversation message: {str(e)}")
+        raise Exception(f"Error saving conversation message: {str(e)}") from e
+
+
+# History writes scheduled off the reply path. Holding the tasks keeps them from
+# being garbage-collected; the last one per chat keeps that chat's rows in order.
+# Rows scheduled for a chat before its write starts are sent in the same POST.
+_background_tasks: set = set()
+_last_save_task: Dict[int, asyncio.Task] = {}
+_pending_rows: Dict[int, list] = {}
+
+
+def save_conversation_message_bg(chat_id: int, role: str, message: str, intent: Optional[str] = None) -> asyncio.Task:
+    """
+    Schedule save_conversation_message without waiting for it.
+    Writes for the same chat still land in the order they were scheduled, and
+    messages queued in the same tick (user + assistant) share one insert;
+    failures are logged, not raised.
+    
+    Returns:
+        The scheduled task (await it to make sure the row was written)
+    """
+    row = _history_row(chat_id, role, message, intent)
+    pending = _pending_rows.get(chat_id)
+    last_task = _last_save_task.get(chat_id)
+    if pending is not None and last_task is not None and not last_task.done():
+        # A write for this chat has not started yet: ride along with it
+        pending.append(row)
+        return last_task
+    
+    rows = [row]
+    _pending_rows[chat_id] = rows
+    task = asyncio.ensure_future(_flush_after(last_task, chat_id, rows))
+    _last_save_task[chat_id] = task
+    _background_tasks.add(task)
+    task.add_done_callback(lambda t: _finish_background_save(chat_id, t))
+    return task
+
+
+async def _flush_after(previous: Optional[asyncio.Task], chat_id: int, rows: list) -> None:
+    try:
+        if previous is not None:
+            await asyncio.wait([previous])
+        else:
+            # Let the rest of the current turn queue its rows first
+            await asyncio.sleep(0)
+    finally:
+        # Stop accepting ride-alongs even if cancelled while waiting, so the
+        # next call for this chat starts a fresh write instead of a dead one
+        if _pending_rows.get(chat_id) is rows:
+            del _pending_rows[chat_id]
+    await save_conversation_messages(rows)
+
+
+def _finish_background_save(chat_id: int, task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if _last_save_task.get(chat_id) is task:
+        del _last_save_task[chat_id]
+        # Only the latest task can own pending rows; drop them if it died before flushing
+        _pending_rows.pop(chat_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Could not save conversation history: {str(task.exception())}")
+
+
+async def drain_background_tasks() -> None:
+    """Wait for every scheduled background write (call before shutting down)."""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
 
 
 async def get_conversation_history(chat_id: int, limit: int = 8) -> list[Dict[str, Any]]:
@@ -602,25 +997,22 @@ async def get_conversation_history(chat_id: int, limit: int = 8) -> list[Dict[st
     """
     try:
         # Allow 6-30 messages (more for mentorship/operational context)
-        limit = max(6, min(30, limit))
-        
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/conversation_history"
-        params = {
-            "chat_id": f"eq.{chat_id}",
-            "order": "created_at.desc",
-            "limit": str(limit)
-        }
+        limit = max(6, min(_HISTORY_WINDOW, limit))
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
+        history = _HISTORY_CACHE.get(chat_id)
+        if history is None:
+            # Load the full window once so any later limit is served from memory
+            url = _HISTORY_URL
+            params = {**_HISTORY_PARAMS, "chat_id": f"eq.{chat_id}"}
             
+            client = get_async_client()
+            response = await client.get(url, params=params)
+            response.raise_for_status()
             # Reverse to get chronological order (oldest first)
-            if isinstance(result, list):
-                return list(reversed(result))
-            return []
+            history = deque(reversed(_rows(response)), maxlen=_HISTORY_WINDOW)
+            _HISTORY_CACHE.set(chat_id, history)
+
+        return list(islice(history, max(len(history) - limit, 0), None))
     except Exception as e:
         logger.error(f"Error getting conversation history: {str(e)}")
         return []
@@ -630,6 +1022,49 @@ async def get_conversation_history(chat_id: int, limit: int = 8) -> list[Dict[st
 # THOUGHTS & REMINDERS FUNCTIONS
 # ============================================
 
+THOUGHT_TYPES = frozenset(("thought", "reminder", "idea", "note"))
+
+_UTC_MIDNIGHT = time(tzinfo=timezone.utc)
+
+# Thought listings by (chat_id, date, type, limit); short TTL absorbs repeated
+# "show my reminders" asks, and writes drop the chat's entries
+_THOUGHTS_CACHE = TTLCache(maxsize=1024, ttl=15)
+
+
+def invalidate_thoughts(chat_id: Optional[int] = None) -> None:
+    """Drop cached thought listings for one chat (or all chats if chat_id is None)."""
+    if chat_id is None:
+        _THOUGHTS_CACHE.clear()
+    else:
+        _THOUGHTS_CACHE.pop_where(lambda key: key[0] == chat_id)
+
+
+def _thought_row(
+    chat_id: int,
+    content: str,
+    thought_type: str = "thought",
+    reminder_date: Optional[str] = None
+) -> Dict[str, Any]:
+    """Validate one thought/reminder and build its thoughts_reminders row."""
+    # Validate type
+    if thought_type not in THOUGHT_TYPES:
+        thought_type = "thought"
+
+    # Validate inputs
+    if not chat_id:
+        raise ValueError("chat_id is required")
+    if not content or not content.strip():
+        raise ValueError("content cannot be empty")
+
+    return {
+        # Ensure chat_id is an integer (BIGINT in database)
+        "chat_id": int(chat_id),
+        "content": content.strip(),
+        "type": thought_type,
+        "reminder_date": reminder_date
+    }
+
+
 async def save_thought_reminder(
     chat_id: int,
     content: str,
@@ -649,71 +1084,53 @@ async def save_thought_reminder(
         Dict with saved thought data
     """
     try:
-        # Validate type
-        valid_types = ["thought", "reminder", "idea", "note"]
-        if thought_type not in valid_types:
-            thought_type = "thought"
-        
-        # Validate inputs
-        if not chat_id:
-            raise ValueError("chat_id is required")
-        if not content or not content.strip():
-            raise ValueError("content cannot be empty")
-        
-        # Ensure chat_id is an integer (BIGINT in database)
-        chat_id = int(chat_id)
-        
-        data = {
-            "chat_id": chat_id,
-            "content": content.strip(),
-            "type": thought_type,
-            "reminder_date": reminder_date
-        }
-        
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/thoughts_reminders"
-        
-        logger.info(f"Saving to Supabase - URL: {url}")
-        logger.info(f"Request data: chat_id={data['chat_id']} (type: {type(data['chat_id'])}), content='{data['content'][:100]}...', type={data['type']}, reminder_date={data['reminder_date']}")
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=data, headers=headers)
-            
-            # Log response for debugging
-            logger.info(f"Supabase response status: {response.status_code}")
-            logger.info(f"Supabase response text: {response.text[:500]}")  # Log first 500 chars
-            
-            # Accept both 200 and 201 as success codes (Supabase may return either)
-            if response.status_code not in [200, 201]:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    error_detail = str(error_json)
-                except:
-                    pass
-                logger.error(f"Supabase error {response.status_code}: {error_detail}")
-                raise Exception(f"Supabase error {response.status_code}: {error_detail}. Request data: {data}")
-            
-            # Parse response
-            try:
-                result = response.json()
+        data = _thought_row(chat_id, content, thought_type, reminder_date)
+        chat_id = data["chat_id"]
+        thought_type = data["type"]
+
+        url = _THOUGHTS_URL
+        # Serialized once: the same bytes are sent and (if INFO is on) logged
+        body = orjson.dumps(data)
+        log_info = logger.isEnabledFor(logging.INFO)
+        if log_info:
+            logger.info(f"Saving to Supabase {url}: {body[:300].decode('utf-8', 'replace')}")
+        
+        client = get_async_client()
+        response = await client.post(url, content=body)
+        invalidate_thoughts(chat_id)
+
+        # Log response for debugging (first 500 chars)
+        if log_info:
+            logger.info(f"Supabase response {response.status_code}: {response.text[:500]}")
+
+        # Accept both 200 and 201 as success codes (Supabase may return either)
+        if response.status_code not in [200, 201]:
+            # PostgREST error bodies are already readable JSON text; no need to re-parse them
+            error_detail = response.text
+            logger.error(f"Supabase error {response.status_code}: {error_detail}")
+            raise Exception(f"Supabase error {response.status_code}: {error_detail}. Request data: {data}")
+
+        # Parse response
+        try:
+            result = orjson.loads(response.content)
+            if log_info:
                 logger.info(f"Successfully saved to Supabase: {result}")
-                # Supabase returns array with Prefer: return=representation
-                return result[0] if isinstance(result, list) and result else result
-            except Exception as e:
-                logger.error(f"Error parsing Supabase response: {str(e)}, Response text: {response.text[:500]}")
-                # If response is empty or not JSON, still consider it success if status is 200/201
-                if response.status_code in [200, 201]:
-                    logger.warning("Supabase returned success but no JSON response, assuming save was successful")
-                    return {"id": "unknown", "chat_id": chat_id, "content": content, "type": thought_type}
-                raise
+            # Supabase returns array with Prefer: return=representation
+            return result[0] if isinstance(result, list) and result else result
+        except Exception as e:
+            logger.error(f"Error parsing Supabase response: {str(e)}, Response text: {response.text[:500]}")
+            # If response is empty or not JSON, still consider it success if status is 200/201
+            if response.status_code in [200, 201]:
+                logger.warning("Supabase returned success but no JSON response, assuming save was successful")
+                return {"id": "unknown", "chat_id": chat_id, "content": content, "type": thought_type}
+            raise
     except httpx.HTTPStatusError as e:
         error_detail = e.response.text if e.response else str(e)
         logger.error(f"HTTP error saving thought: {error_detail}")
-        raise Exception(f"Error saving thought/reminder (HTTP {e.response.status_code if e.response else 'unknown'}): {error_detail}")
+        raise Exception(f"Error saving thought/reminder (HTTP {e.response.status_code if e.response else 'unknown'}): {error_detail}") from e
     except Exception as e:
         logger.error(f"Error saving thought/reminder: {str(e)}", exc_info=True)
-        raise Exception(f"Error saving thought/reminder: {str(e)}")
+        raise Exception(f"Error saving thought/reminder: {str(e)}") from e
 
 
 async def get_thoughts_reminders(
@@ -732,14 +1149,29 @@ async def get_thoughts_reminders(
         limit: Maximum number of results (default: 50)
         
     Returns:
-        List of thoughts/reminders dictionaries
+        List of thoughts/reminders dictionaries (shared with the cache: do not mutate)
     """
+    key = (int(chat_id), date.lower() if date else None, thought_type, limit)
     try:
-        from datetime import datetime, timedelta
-        
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/thoughts_reminders"
+        return await _THOUGHTS_CACHE.get_or_load(
+            key, lambda: _fetch_thoughts_reminders(chat_id, date, thought_type, limit)
+        )
+    except Exception as e:
+        # The loader already prefixes "Error getting thoughts/reminders"
+        logger.error(str(e))
+        return []
+
+
+async def _fetch_thoughts_reminders(
+    chat_id: int,
+    date: Optional[str],
+    thought_type: Optional[str],
+    limit: int
+) -> list[Dict[str, Any]]:
+    try:
+        url = _THOUGHTS_URL
         params = {
+            "select": _THOUGHT_SELECT,
             "chat_id": f"eq.{chat_id}",
             "order": "created_at.desc",
             "limit": str(limit)
@@ -747,62 +1179,36 @@ async def get_thoughts_reminders(
         
         # Handle type filter
         if thought_type:
-            valid_types = ["thought", "reminder", "idea", "note"]
-            if thought_type in valid_types:
+            if thought_type in THOUGHT_TYPES:
                 params["type"] = f"eq.{thought_type}"
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            result_list = result if isinstance(result, list) else []
-            
-            # Handle date filter manually (more flexible)
-            if date:
-                if date.lower() == "today":
-                    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                    today_end = datetime.now().replace(hour=23, minute=59, second=59, microsecond=999999)
-                elif date.lower() == "yesterday":
-                    yesterday = datetime.now() - timedelta(days=1)
-                    today_start = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-                    today_end = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-                else:
-                    # Assume format YYYY-MM-DD
-                    try:
-                        target_date = datetime.strptime(date, "%Y-%m-%d")
-                        today_start = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                        today_end = target_date.replace(hour=23, minute=59, second=59, microsecond=999999)
-                    except:
-                        return result_list
-                
-                date_filter = today_start.date().isoformat()
-                filtered = []
-                
-                for item in result_list:
-                    created_str = item.get("created_at", "")
-                    reminder_str = item.get("reminder_date", "")
-                    
-                    # Check if reminder_date matches
-                    if reminder_str and str(reminder_str) == date_filter:
-                        filtered.append(item)
-                        continue
-                    
-                    # Check if created_at matches the day
-                    if created_str:
-                        try:
-                            created_dt = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                            created_dt_naive = created_dt.replace(tzinfo=None)
-                            if today_start <= created_dt_naive <= today_end:
-                                filtered.append(item)
-                        except:
-                            pass
-                
-                return filtered
-            
-            return result_list
-    except Exception as e:
-        logger.error(f"Error getting thoughts/reminders: {str(e)}")
-        return []
+        # Date filter runs in PostgREST: reminder_date on that day, or created_at inside it (UTC)
+        if date:
+            if date.lower() == "today":
+                day = datetime.now(timezone.utc).date()
+            elif date.lower() == "yesterday":
+                day = datetime.now(timezone.utc).date() - timedelta(days=1)
+            else:
+                # Assume format YYYY-MM-DD; an unparseable date leaves the day unfiltered
+                try:
+                    day = datetime.strptime(date, "%Y-%m-%d").date()
+                except ValueError:
+                    day = None
+
+            if day is not None:
+                day_start = datetime.combine(day, _UTC_MIDNIGHT)
+                day_end = day_start + timedelta(days=1)
+                params["or"] = (
+                    f"(reminder_date.eq.{day.isoformat()},"
+                    f"and(created_at.gte.{_utc_iso(day_start)},created_at.lt.{_utc_iso(day_end)}))"
+                )
+
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        return _rows(response)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        raise Exception(f"Error getting thoughts/reminders: {str(e)}") from e
 
 
 async def update_thought_completed(thought_id: str, is_completed: bool = True) -> Dict[str, Any]:
@@ -817,24 +1223,121 @@ async def update_thought_completed(thought_id: str, is_completed: bool = True) -
         Updated thought dictionary
     """
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/thoughts_reminders"
+        url = _THOUGHTS_URL
         params = {"id": f"eq.{thought_id}"}
         data = {"is_completed": is_completed}
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.patch(url, params=params, json=data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            return result[0] if isinstance(result, list) and result else result
+        client = get_async_client()
+        response = await client.patch(url, params=params, content=orjson.dumps(data))
+        response.raise_for_status()
+        row = _first_row(response)
+        # Only the returned row knows its chat; without it, drop every cached listing
+        invalidate_thoughts(row.get("chat_id") if row else None)
+        return row
     except Exception as e:
-        raise Exception(f"Error updating thought completion status: {str(e)}")
+        raise Exception(f"Error updating thought completion status: {str(e)}") from e
 
 
 # ============================================
 # SCHEDULE REMINDERS FUNCTIONS (Recordatorios proactivos)
 # ============================================
 
+async def get_enabled_schedule_reminders() -> list:
+    """
+    Get every enabled schedule reminder (one request; filter with
+    filter_pending_schedule_reminders / seconds_until_next_schedule_reminder).
+    
+    Returns:
+        List of reminder dicts ([] on error)
+    """
+    try:
+        url = _SCHEDULE_URL
+        params = {"enabled": "eq.true"}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        return _rows(response)
+    except Exception as e:
+        logger.error(f"Error getting schedule reminders: {str(e)}")
+        return []
+
+
+def _reminder_runs_on(reminder: Dict[str, Any], date_iso: str, weekday: int) -> bool:
+    """True if the reminder is scheduled for that day (specific_date or days_of_week)."""
+    specific_date = reminder.get("specific_date")
+    if specific_date is not None:
+        return str(specific_date) == date_iso
+    days_str = str(reminder.get("days_of_week", ""))
+    if not days_str:
+        return False
+    days = [int(d.strip()) for d in days_str.split(",") if d.strip().isdigit()]
+    return weekday in days
+
+
+def filter_pending_schedule_reminders(
+    reminders: list,
+    current_hour: int,
+    current_minute: int,
+    current_weekday: int,
+    current_date: str
+) -> list:
+    """
+    Keep the reminders that should be sent now: (hour, minute) within 15 min of
+    the current time, scheduled for today, and last_sent_date != today.
+    """
+    current_slot = current_hour * 60 + current_minute
+    pending = []
+    
+    for r in reminders:
+        if not _reminder_runs_on(r, current_date, current_weekday):
+            continue
+        
+        last_sent = r.get("last_sent_date")
+        if last_sent and str(last_sent) == current_date:
+            continue
+        
+        rem_hour = int(r.get("hour", 0))
+        rem_minute = int(r.get("minute", 0))
+        rem_slot = rem_hour * 60 + rem_minute
+        diff = abs(current_slot - rem_slot)
+        if diff <= 15:
+            pending.append(r)
+    
+    return pending
+
+
+def seconds_until_next_schedule_reminder(reminders: list, now: datetime) -> Optional[float]:
+    """
+    Seconds from now (local wall clock) to the next reminder slot, looking a week ahead.
+    
+    Args:
+        reminders: Rows from get_enabled_schedule_reminders
+        now: Current time in the reminders' timezone
+    
+    Returns:
+        Seconds until the next (hour, minute) slot, or None if nothing is scheduled
+    """
+    wall_now = now.replace(tzinfo=None)
+    today = wall_now.date()
+    for offset in range(8):
+        day = today + timedelta(days=offset)
+        date_iso = day.isoformat()
+        slots = []
+        for r in reminders:
+            if not _reminder_runs_on(r, date_iso, day.weekday()):
+                continue
+            last_sent = r.get("last_sent_date")
+            if last_sent and str(last_sent) == date_iso:
+                continue
+            slot = datetime.combine(day, time(int(r.get("hour", 0)), int(r.get("minute", 0))))
+            if slot > wall_now:
+                slots.append(slot)
+        if slots:
+            return (min(slots) - wall_now).total_seconds()
+    return None
+
+
 async def get_pending_schedule_reminders(
     current_hour: int,
     current_minute: int,
@@ -855,65 +1358,22 @@ async def get_pending_schedule_reminders(
     Returns:
         List of reminder dicts to send
     """
-    try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/schedule_reminders"
-        params = {"enabled": "eq.true"}
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            reminders = response.json()
-        
-        if not isinstance(reminders, list):
-            return []
-        
-        current_slot = current_hour * 60 + current_minute
-        pending = []
-        
-        for r in reminders:
-            specific_date = r.get("specific_date")
-            if specific_date is not None:
-                if str(specific_date) != current_date:
-                    continue
-            else:
-                days_str = str(r.get("days_of_week", ""))
-                if not days_str:
-                    continue
-                days = [int(d.strip()) for d in days_str.split(",") if d.strip().isdigit()]
-                if current_weekday not in days:
-                    continue
-            
-            last_sent = r.get("last_sent_date")
-            if last_sent and str(last_sent) == current_date:
-                continue
-            
-            rem_hour = int(r.get("hour", 0))
-            rem_minute = int(r.get("minute", 0))
-            rem_slot = rem_hour * 60 + rem_minute
-            diff = abs(current_slot - rem_slot)
-            if diff <= 15:
-                pending.append(r)
-        
-        return pending
-    except Exception as e:
-        logger.error(f"Error getting pending reminders: {str(e)}")
-        return []
+    reminders = await get_enabled_schedule_reminders()
+    return filter_pending_schedule_reminders(
+        reminders, current_hour, current_minute, current_weekday, current_date
+    )
 
 
 async def mark_reminder_sent(reminder_id: str, sent_date: str, is_one_time: bool = False) -> bool:
     """Update last_sent_date after sending. If one-time, disable the reminder."""
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/schedule_reminders"
+        url = _SCHEDULE_URL
         params = {"id": f"eq.{reminder_id}"}
         data = {"last_sent_date": sent_date}
         if is_one_time:
             data["enabled"] = False
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.patch(url, params=params, json=data, headers=headers)
-            response.raise_for_status()
+        await _write("PATCH", url, data, params=params)
         return True
     except Exception as e:
         logger.error(f"Error marking reminder sent: {str(e)}")
@@ -937,14 +1397,12 @@ async def ensure_default_reminders_for_chat(chat_id: int) -> int:
     Returns: número de recordatorios insertados.
     """
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/schedule_reminders"
+        url = _SCHEDULE_URL
         params = {"chat_id": f"eq.{chat_id}"}
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.get(url, params=params, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
-            existing_list = data if isinstance(data, list) else []
+        client = get_async_client()
+        resp = await client.get(url, params=params)
+        resp.raise_for_status()
+        existing_list = _rows(resp)
         if len(existing_list) >= 3:  # Ya tiene recordatorios
             return 0
         inserted = 0
@@ -958,10 +1416,10 @@ async def ensure_default_reminders_for_chat(chat_id: int) -> int:
                 "reminder_type": rem_type,
                 "enabled": True,
             }
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                resp = await client.post(url, json=data, headers=headers)
-                if resp.status_code in (200, 201):
-                    inserted += 1
+            client = get_async_client()
+            resp = await client.post(url, content=orjson.dumps(data), headers=_PREFER_MINIMAL)
+            if resp.status_code in (200, 201):
+                inserted += 1
         return inserted
     except Exception as e:
         logger.error(f"Error ensuring default reminders: {str(e)}")
@@ -974,22 +1432,14 @@ async def save_custom_schedule_reminder(
     minute: int,
     message: str,
     specific_date: Optional[str] = None,
-) -> Optional[Dict[str, Any]]:
+) -> bool:
     """
     Inserta un recordatorio personalizado (ej: "recuérdame a las 4 tal cosa").
     specific_date: 'YYYY-MM-DD' para uno único (ej. mañana). Si es None, se usa la fecha de hoy = recordatorio único para hoy.
+    Returns: True si se guardó.
     """
     try:
-        from datetime import datetime
-        tz_name = os.getenv("KEPLER_TZ", "America/Bogota")
-        try:
-            import pytz
-            tz = pytz.timezone(tz_name)
-        except Exception:
-            from datetime import timezone
-            now = datetime.now(timezone.utc)
-        else:
-            now = datetime.now(tz)
+        now = datetime.now(KEPLER_TZINFO)
         # Si no hay fecha específica (ej. "recuérdame a las 4") = recordatorio único para hoy
         target_date = specific_date if specific_date else now.date().isoformat()
         days_of_week = "0,1,2,3,4,5,6"
@@ -1003,36 +1453,42 @@ async def save_custom_schedule_reminder(
             "enabled": True,
             "specific_date": target_date,  # Siempre fijamos fecha: hoy o mañana = un solo envío
         }
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/schedule_reminders"
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(url, json=data, headers=headers)
-            if resp.status_code in (200, 201):
-                result = resp.json()
-                return result[0] if isinstance(result, list) and result else result
-        return None
+        await _write("POST", _SCHEDULE_URL, data)
+        return True
     except Exception as e:
         logger.error(f"Error saving custom reminder: {str(e)}")
-        return None
+        return False
 
 
 async def get_registered_chat_ids() -> list:
     """Get distinct chat_ids that have reminders enabled."""
     try:
-        headers = get_supabase_headers()
-        url = f"{supabase_url}/rest/v1/schedule_reminders"
+        url = _SCHEDULE_URL
         params = {"enabled": "eq.true", "select": "chat_id"}
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-        
-        if not isinstance(result, list):
-            return []
-        chat_ids = list(set(int(r["chat_id"]) for r in result if r.get("chat_id") is not None))
+        client = get_async_client()
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        chat_ids = list(set(int(r["chat_id"]) for r in _rows(response) if r.get("chat_id") is not None))
         return chat_ids
     except Exception as e:
         logger.error(f"Error getting chat ids: {str(e)}")
         return []
 
+
+
+async def count_schedule_reminders() -> int:
+    """Count every row in schedule_reminders (server-side count, no rows transferred)."""
+    try:
+        url = _SCHEDULE_URL
+        params = {"select": "id", "limit": "1"}
+        
+        client = get_async_client()
+        response = await client.get(url, params=params, headers=_PREFER_COUNT_EXACT)
+        response.raise_for_status()
+        # Content-Range: "0-0/<total>" (or "*/0" when the table is empty)
+        total = response.headers.get("content-range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else 0
+    except Exception as e:
+        logger.error(f"Error counting reminders: {str(e)}")
+        return 0
@@ -2,18 +2,60 @@
 Telegram bot integration for sending messages.
 """
 import os
+import time
 import httpx
+import orjson
 import logging
-from typing import Optional
+from typing import Optional, AsyncIterator
 from dotenv import load_dotenv
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 deja que los envíos concurrentes compartan una conexión (requiere h2)
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}" if TELEGRAM_BOT_TOKEN else None
 
+# Bodies are serialized with orjson, so the content type is set by hand
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Cliente HTTP compartido: reutiliza la conexión TLS con api.telegram.org entre mensajes
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_telegram_client() -> httpx.AsyncClient:
+    """Get or create the pooled httpx client for the Telegram Bot API."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=TELEGRAM_API_URL or "",
+            headers=_JSON_HEADERS,
+            # sendMessage/editMessageText responden rápido: límite explícito, como en core/db.py
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            # Solo reintenta fallos de conexión: un sendMessage que llegó a Telegram no se repite
+            transport=httpx.AsyncHTTPTransport(
+                retries=2,
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_keepalive_connections=10, max_connections=50),
+            ),
+        )
+    return _client
+
+
+async def close_telegram_client() -> None:
+    """Close the pooled Telegram client (call on application shutdown)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 async def send_message(chat_id: int, text: str) -> bool:
     """
@@ -31,18 +73,122 @@ async def send_message(chat_id: int, text: str) -> bool:
         return False
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{TELEGRAM_API_URL}/sendMessage",
-                json={
-                    "chat_id": chat_id,
-                    "text": text,
-                    "parse_mode": "HTML"
-                }
-            )
-            response.raise_for_status()
-            return True
+        client = get_telegram_client()
+        response = await client.post(
+            "/sendMessage",
+            content=orjson.dumps({
+                "chat_id": chat_id,
+                "text": text,
+                "parse_mode": "HTML"
+            }),
+        )
+        response.raise_for_status()
+        return True
     except Exception as e:
         logger.error(f"Error sending Telegram message: {str(e)}")
         return False
 
+
+
+async def send_message_with_id(chat_id: int, text: str) -> Optional[int]:
+    """
+    Send a message and return its Telegram message_id (needed to edit it later).
+    
+    Returns:
+        message_id if successful, None otherwise
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN not set, cannot send message")
+        return None
+    
+    try:
+        client = get_telegram_client()
+        response = await client.post(
+            "/sendMessage",
+            content=orjson.dumps({
+                "chat_id": chat_id,
+                "text": text,
+                "parse_mode": "HTML"
+            }),
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content).get("result", {}).get("message_id")
+    except Exception as e:
+        logger.error(f"Error sending Telegram message: {str(e)}")
+        return None
+
+
+async def edit_message(chat_id: int, message_id: int, text: str) -> bool:
+    """
+    Replace the text of a message previously sent by the bot.
+    
+    Returns:
+        True if successful, False otherwise
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        return False
+    
+    try:
+        client = get_telegram_client()
+        response = await client.post(
+            "/editMessageText",
+            content=orjson.dumps({
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "text": text,
+                "parse_mode": "HTML"
+            }),
+        )
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        # Texto parcial con HTML sin cerrar puede fallar; la edición final lo corrige
+        logger.warning(f"Error editing Telegram message: {str(e)}")
+        return False
+
+
+async def stream_message(chat_id: int, chunks: AsyncIterator[str], edit_interval: float = 1.0) -> str:
+    """
+    Send a streamed reply: the first chunk creates the message and the rest of
+    the text is applied with edits (at most one every edit_interval seconds,
+    Telegram throttles faster edits).
+    
+    Args:
+        chat_id: Telegram chat ID
+        chunks: Async iterator of text fragments
+        edit_interval: Minimum seconds between edits
+        
+    Returns:
+        The full text that was sent
+    """
+    text = ""
+    shown = ""
+    message_id = None
+    first_send_failed = False
+    last_edit = 0.0
+    
+    async for chunk in chunks:
+        text += chunk
+        if first_send_failed or not text.strip():
+            # Tras un primer envío fallido solo se acumula: un único envío al final
+            continue
+        if message_id is None:
+            message_id = await send_message_with_id(chat_id, text)
+            first_send_failed = message_id is None
+            shown = text
+            last_edit = time.monotonic()
+        elif time.monotonic() - last_edit >= edit_interval:
+            await edit_message(chat_id, message_id, text)
+            shown = text
+            last_edit = time.monotonic()
+    
+    text = text.strip()
+    if message_id is None:
+        # No se pudo crear el mensaje incremental: enviar el texto completo
+        if text:
+            await send_message(chat_id=chat_id, text=text)
+    elif text != shown.strip():
+        if not await edit_message(chat_id, message_id, text):
+            # La última edición falló: el mensaje visible quedó truncado
+            await send_message(chat_id=chat_id, text=text)
+    return text
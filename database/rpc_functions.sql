@@ -0,0 +1,120 @@
+-- Funciones RPC para operaciones atómicas desde la API REST (PostgREST)
+-- Ejecuta esto completo en Supabase SQL Editor
+-- Se llaman con POST /rest/v1/rpc/<nombre_funcion>
+
+-- ============================================
+-- 1. increment_budget_spent: suma un gasto al presupuesto en un solo UPDATE
+-- ============================================
+-- Evita el GET + PATCH (dos viajes y carrera entre gastos simultáneos)
+CREATE OR REPLACE FUNCTION increment_budget_spent(p_category TEXT, p_amount NUMERIC)
+RETURNS SETOF budgets
+LANGUAGE sql
+AS $$
+  UPDATE budgets
+  SET current_spent = COALESCE(current_spent, 0) + p_amount
+  WHERE category = p_category
+  RETURNING *;
+$$;
+
+GRANT EXECUTE ON FUNCTION increment_budget_spent(TEXT, NUMERIC) TO anon, authenticated, service_role;
+
+-- ============================================
+-- 2. register_expense: registra el gasto y devuelve el estado del presupuesto
+-- ============================================
+-- Inserta la transacción + suma al presupuesto en una sola transacción (un viaje)
+-- Devuelve lo mismo que get_budget_status: category, monthly_limit, current_spent, remaining
+CREATE OR REPLACE FUNCTION register_expense(
+  p_amount NUMERIC,
+  p_category TEXT,
+  p_description TEXT DEFAULT NULL,
+  p_type TEXT DEFAULT 'expense'
+)
+RETURNS TABLE (category TEXT, monthly_limit NUMERIC, current_spent NUMERIC, remaining NUMERIC)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  INSERT INTO transactions (amount, category, description, type)
+  VALUES (p_amount, p_category, NULLIF(p_description, ''), p_type);
+
+  RETURN QUERY
+  UPDATE budgets b
+  SET current_spent = COALESCE(b.current_spent, 0) + p_amount
+  WHERE b.category = p_category
+  RETURNING b.category::TEXT, b.monthly_limit::NUMERIC, b.current_spent::NUMERIC,
+            (b.monthly_limit - b.current_spent)::NUMERIC;
+
+  -- Sin presupuesto para la categoría: se revierte también el INSERT
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'Budget not found for category: %', p_category;
+  END IF;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION register_expense(NUMERIC, TEXT, TEXT, TEXT) TO anon, authenticated, service_role;
+
+-- ============================================
+-- 3. decrement_debt_balance: aplica un pago a la deuda en un solo UPDATE
+-- ============================================
+-- Evita el GET + PATCH; el saldo nunca baja de 0
+CREATE OR REPLACE FUNCTION decrement_debt_balance(p_name TEXT, p_payment NUMERIC)
+RETURNS SETOF debts
+LANGUAGE sql
+AS $$
+  UPDATE debts
+  SET current_balance = GREATEST(0, current_balance - p_payment)
+  WHERE name = p_name
+  RETURNING *;
+$$;
+
+GRANT EXECUTE ON FUNCTION decrement_debt_balance(TEXT, NUMERIC) TO anon, authenticated, service_role;
+
+-- ============================================
+-- 4. monthly_income: suma de ingresos desde una fecha
+-- ============================================
+-- Devuelve un solo número en vez de todas las filas de ingreso del mes
+CREATE OR REPLACE FUNCTION monthly_income(p_start TIMESTAMPTZ)
+RETURNS NUMERIC
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT COALESCE(SUM(amount), 0)
+  FROM transactions
+  WHERE type = 'income' AND created_at >= p_start;
+$$;
+
+GRANT EXECUTE ON FUNCTION monthly_income(TIMESTAMPTZ) TO anon, authenticated, service_role;
+
+-- ============================================
+-- 5. financial_state: presupuestos, deudas, patrimonio y totales del mes
+-- ============================================
+-- Todo el estado financiero en un solo viaje (usado por get_complete_financial_state)
+CREATE OR REPLACE FUNCTION financial_state(p_start TIMESTAMPTZ)
+RETURNS JSON
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT json_build_object(
+    'budgets', COALESCE((
+      SELECT json_agg(b) FROM (SELECT category, monthly_limit, current_spent FROM budgets) b
+    ), '[]'::json),
+    'debts', COALESCE((
+      SELECT json_agg(d)
+      FROM (SELECT name, initial_balance, current_balance, minimum_payment FROM debts) d
+    ), '[]'::json),
+    'total_debt', (SELECT COALESCE(SUM(current_balance), 0) FROM debts),
+    'patrimony', (
+      SELECT row_to_json(p)
+      FROM (
+        SELECT id, initial_balance, current_balance, last_month_income, last_month_expenses
+        FROM patrimony LIMIT 1
+      ) p
+    ),
+    'monthly_income', (
+      SELECT COALESCE(SUM(amount), 0)
+      FROM transactions
+      WHERE type = 'income' AND created_at >= p_start
+    )
+  );
+$$;
+
+GRANT EXECUTE ON FUNCTION financial_state(TIMESTAMPTZ) TO anon, authenticated, service_role;
@@ -0,0 +1,9 @@
+-- Índice para búsquedas por descripción en transactions
+-- Ejecuta esto en Supabase SQL Editor (una sola vez)
+-- get_transactions filtra con description=ilike.*texto*; sin este índice
+-- Postgres recorre toda la tabla en cada búsqueda.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_transactions_description_trgm
+  ON transactions USING GIN (description gin_trgm_ops);
@@ -2,7 +2,7 @@
 Script local para enviar recordatorios del Plan Kepler.
 100% gratis: corre en tu PC o en cualquier servidor donde lo ejecutes.
 
-Uso: python run_reminders.py
+Uso: python run_reminders.py (despierta en la hora del próximo recordatorio, revisando al menos cada 15 min)
 
 Déjalo corriendo (o úsalo con un gestor de procesos como pm2/supervisor).
 Necesita .env con SUPABASE_URL, SUPABASE_KEY, TELEGRAM_BOT_TOKEN.
@@ -10,60 +10,106 @@ Necesita .env con SUPABASE_URL, SUPABASE_KEY, TELEGRAM_BOT_TOKEN.
 import asyncio
 import os
 from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Timezone (default Colombia)
+KEPLER_TZ = os.getenv("KEPLER_TZ", "America/Bogota")
+# Se resuelve una vez; None = hora local si no se puede cargar la zona
+try:
+    KEPLER_TZINFO = ZoneInfo(KEPLER_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    KEPLER_TZINFO = None
+
+# Máximo de recordatorios en vuelo a la vez (Telegram limita ~30 msg/s por bot)
+MAX_CONCURRENT_SENDS = 20
+
+# Se duerme hasta el próximo recordatorio, pero nunca más de esto (para ver los nuevos)
+# ni menos de esto (para no girar en vacío si la hora cae justo en el borde)
+MAX_SLEEP_SECONDS = 15 * 60
+MIN_SLEEP_SECONDS = 5
+
+
 def get_now():
-    tz_name = os.getenv("KEPLER_TZ", "America/Bogota")
-    try:
-        import pytz
-        tz = pytz.timezone(tz_name)
-        return datetime.now(tz)
-    except Exception:
-        return datetime.now()
+    return datetime.now(KEPLER_TZINFO)
 
 
 async def run_reminders():
-    from core.db import get_pending_schedule_reminders, mark_reminder_sent
+    """
+    Envía los recordatorios pendientes.
+    Returns: (enviados, segundos hasta el próximo recordatorio o None si no hay ninguno)
+    """
+    from core.db import (
+        get_enabled_schedule_reminders,
+        filter_pending_schedule_reminders,
+        seconds_until_next_schedule_reminder,
+        mark_reminder_sent,
+    )
     from core.telegram import send_message
 
     now = get_now()
     current_date = now.date().isoformat()
     current_weekday = now.weekday()  # 0=Lunes, 6=Domingo
 
-    pending = await get_pending_schedule_reminders(
+    # Una sola consulta sirve para los pendientes y para calcular el próximo despertar
+    reminders = await get_enabled_schedule_reminders()
+    pending = filter_pending_schedule_reminders(
+        reminders,
         current_hour=now.hour,
         current_minute=now.minute,
         current_weekday=current_weekday,
         current_date=current_date,
     )
 
-    sent = 0
-    for rem in pending:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+    async def _process(rem):
         chat_id = rem.get("chat_id")
         message = rem.get("message", "")
-        rem_id = rem.get("id")
-        if chat_id and message:
-            await send_message(chat_id=int(chat_id), text=message)
-            await mark_reminder_sent(rem_id, current_date)
-            sent += 1
-            print(f"[{now.strftime('%H:%M')}] Enviado a {chat_id}: {message[:50]}...")
+        async with semaphore:
+            # send_message no lanza (devuelve False), así que marcar no depende del envío
+            await asyncio.gather(
+                send_message(chat_id=int(chat_id), text=message),
+                mark_reminder_sent(rem.get("id"), current_date),
+            )
+        rem["last_sent_date"] = current_date
+        print(f"[{now.strftime('%H:%M')}] Enviado a {chat_id}: {message[:50]}...")
+
+    # Se envían en paralelo (acotado por el semáforo) en vez de uno tras otro
+    results = await asyncio.gather(
+        *[_process(rem) for rem in pending if rem.get("chat_id") and rem.get("message")],
+        return_exceptions=True,
+    )
+    for error in results:
+        if isinstance(error, Exception):
+            print(f"Error enviando recordatorio: {error}")
+    sent = sum(1 for r in results if not isinstance(r, Exception))
 
-    return sent
+    return sent, seconds_until_next_schedule_reminder(reminders, get_now())
 
 
 async def main():
-    interval_minutes = 15
-    print(f"Recordatorios Kepler - cada {interval_minutes} min. Ctrl+C para salir.")
-    while True:
-        try:
-            await run_reminders()
-        except Exception as e:
-            print(f"Error: {e}")
-        await asyncio.sleep(interval_minutes * 60)
+    from core.db import close_async_client
+    from core.telegram import close_telegram_client
+
+    print(f"Recordatorios Kepler - hasta el próximo recordatorio (máx. {MAX_SLEEP_SECONDS // 60} min). Ctrl+C para salir.")
+    try:
+        while True:
+            delay = MAX_SLEEP_SECONDS
+            try:
+                _, next_in = await run_reminders()
+                if next_in is not None:
+                    delay = min(max(next_in, MIN_SLEEP_SECONDS), MAX_SLEEP_SECONDS)
+            except Exception as e:
+                print(f"Error: {e}")
+            await asyncio.sleep(delay)
+    finally:
+        # Los clientes de Supabase y Telegram se reutilizan entre rondas; se cierran al salir
+        await close_async_client()
+        await close_telegram_client()
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ Prueba todas las conexiones y configuraciones.
 """
 import os
 import sys
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -34,115 +35,138 @@ def test_env_variables():
     return all_ok
 
 
-def test_supabase():
+def _section(out, title):
+    """Agrega el encabezado de una sección al buffer de salida."""
+    out.append("\n" + "=" * 50)
+    out.append(title)
+    out.append("=" * 50)
+
+
+# Las pruebas de red corren en paralelo: cada una acumula su salida y devuelve
+# (ok, líneas) para imprimirse en orden cuando todas terminan.
+
+async def test_supabase():
     """Prueba la conexión con Supabase."""
-    print("\n" + "=" * 50)
-    print("2. VERIFICANDO CONEXIÓN CON SUPABASE")
-    print("=" * 50)
+    out = []
+    _section(out, "2. VERIFICANDO CONEXIÓN CON SUPABASE")
     
     try:
-        from supabase import create_client
+        from core.db import get_async_client, close_async_client
         
-        supabase_url = os.getenv("SUPABASE_URL")
-        supabase_key = os.getenv("SUPABASE_KEY")
+        if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_KEY"):
+            out.append("❌ Variables de Supabase no configuradas")
+            return False, out
         
-        if not supabase_url or not supabase_key:
-            print("❌ Variables de Supabase no configuradas")
-            return False
-        
-        client = create_client(supabase_url, supabase_key)
+        # Mismo cliente async que usa la app (core/db.py)
+        client = get_async_client()
+        try:
+            budgets, transactions = await asyncio.gather(
+                client.get("/budgets", params={"select": "*", "limit": "1"}),
+                client.get("/transactions", params={"select": "*", "limit": "1"}),
+            )
+        finally:
+            await close_async_client()
         
         # Intentar leer de la tabla budgets
-        result = client.table("budgets").select("*").limit(1).execute()
-        print("✅ Conexión con Supabase: EXITOSA")
-        print(f"   Tabla 'budgets' accesible: ✅")
+        budgets.raise_for_status()
+        out.append("✅ Conexión con Supabase: EXITOSA")
+        out.append(f"   Protocolo: {budgets.http_version}")
+        out.append(f"   Tabla 'budgets' accesible: ✅")
         
         # Verificar tabla transactions
-        try:
-            result = client.table("transactions").select("*").limit(1).execute()
-            print(f"   Tabla 'transactions' accesible: ✅")
-        except Exception as e:
-            print(f"   ⚠️  Tabla 'transactions': {str(e)}")
+        if transactions.is_success:
+            out.append(f"   Tabla 'transactions' accesible: ✅")
+        else:
+            out.append(f"   ⚠️  Tabla 'transactions': HTTP {transactions.status_code}")
         
-        return True
+        return True, out
         
     except Exception as e:
-        print(f"❌ Error conectando con Supabase: {str(e)}")
-        return False
+        out.append(f"❌ Error conectando con Supabase: {str(e)}")
+        return False, out
 
 
-def test_openai():
+async def test_openai():
     """Prueba la conexión con OpenAI."""
-    print("\n" + "=" * 50)
-    print("3. VERIFICANDO CONEXIÓN CON OPENAI")
-    print("=" * 50)
+    out = []
+    _section(out, "3. VERIFICANDO CONEXIÓN CON OPENAI")
     
     try:
-        from openai import OpenAI
+        from openai import AsyncOpenAI
         
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key or api_key.startswith("tu_"):
-            print("❌ OPENAI_API_KEY no configurada correctamente")
-            return False
+            out.append("❌ OPENAI_API_KEY no configurada correctamente")
+            return False, out
         
-        client = OpenAI(api_key=api_key)
-        
-        # Hacer una llamada simple de prueba
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "user", "content": "Responde solo 'OK'"}
-            ],
-            max_tokens=5
-        )
+        client = AsyncOpenAI(api_key=api_key)
+        try:
+            # Hacer una llamada simple de prueba
+            await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "user", "content": "Responde solo 'OK'"}
+                ],
+                max_tokens=5
+            )
+        finally:
+            await client.close()
         
-        print("✅ Conexión con OpenAI: EXITOSA")
-        print(f"   Modelo 'gpt-4o-mini' disponible: ✅")
-        return True
+        out.append("✅ Conexión con OpenAI: EXITOSA")
+        out.append(f"   Modelo 'gpt-4o-mini' disponible: ✅")
+        return True, out
         
     except Exception as e:
-        print(f"❌ Error conectando con OpenAI: {str(e)}")
+        out.append(f"❌ Error conectando con OpenAI: {str(e)}")
         if "Invalid API key" in str(e):
-            print("   💡 Verifica que tu API key sea correcta")
-        return False
+            out.append("   💡 Verifica que tu API key sea correcta")
+        return False, out
 
 
-def test_telegram():
+async def test_telegram():
     """Prueba la conexión con Telegram."""
-    print("\n" + "=" * 50)
-    print("4. VERIFICANDO CONEXIÓN CON TELEGRAM")
-    print("=" * 50)
+    out = []
+    _section(out, "4. VERIFICANDO CONEXIÓN CON TELEGRAM")
     
     try:
         import httpx
         
         bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
         if not bot_token or bot_token.startswith("tu_"):
-            print("❌ TELEGRAM_BOT_TOKEN no configurada correctamente")
-            return False
+            out.append("❌ TELEGRAM_BOT_TOKEN no configurada correctamente")
+            return False, out
         
         # Probar getMe endpoint
         url = f"https://api.telegram.org/bot{bot_token}/getMe"
         
-        response = httpx.get(url, timeout=10)
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.get(url)
         response.raise_for_status()
         
         data = response.json()
         if data.get("ok"):
             bot_info = data.get("result", {})
-            print("✅ Conexión con Telegram: EXITOSA")
-            print(f"   Bot: @{bot_info.get('username', 'N/A')}")
-            print(f"   Nombre: {bot_info.get('first_name', 'N/A')}")
-            return True
+            out.append("✅ Conexión con Telegram: EXITOSA")
+            out.append(f"   Bot: @{bot_info.get('username', 'N/A')}")
+            out.append(f"   Nombre: {bot_info.get('first_name', 'N/A')}")
+            return True, out
         else:
-            print(f"❌ Error en respuesta de Telegram: {data.get('description', 'Unknown')}")
-            return False
+            out.append(f"❌ Error en respuesta de Telegram: {data.get('description', 'Unknown')}")
+            return False, out
             
     except Exception as e:
-        print(f"❌ Error conectando con Telegram: {str(e)}")
+        out.append(f"❌ Error conectando con Telegram: {str(e)}")
         if "Unauthorized" in str(e):
-            print("   💡 Verifica que tu bot token sea correcto")
-        return False
+            out.append("   💡 Verifica que tu bot token sea correcto")
+        return False, out
+
+
+async def run_network_checks():
+    """Lanza Supabase, OpenAI y Telegram a la vez e imprime cada sección en orden."""
+    results = await asyncio.gather(test_supabase(), test_openai(), test_telegram())
+    for _, lines in results:
+        print("\n".join(lines))
+    return [ok for ok, _ in results]
 
 
 def test_imports():
@@ -155,7 +179,6 @@ def test_imports():
         ("fastapi", "FastAPI"),
         ("uvicorn", "Uvicorn"),
         ("openai", "OpenAI"),
-        ("supabase", "Supabase"),
         ("httpx", "HTTPX"),
         ("pydantic", "Pydantic"),
     ]
@@ -171,7 +194,7 @@ def test_imports():
     
     # Probar imports locales
     try:
-        from core.brain import classify_expense, generate_response
+        from core.brain import classify_financial_action, generate_cfo_response
         print("✅ core.brain: Importado correctamente")
     except Exception as e:
         print(f"❌ core.brain: Error - {str(e)}")
@@ -201,10 +224,11 @@ def main():
     results = {
         "Variables de entorno": test_env_variables(),
         "Imports": test_imports(),
-        "Supabase": test_supabase(),
-        "OpenAI": test_openai(),
-        "Telegram": test_telegram(),
     }
+    supabase_ok, openai_ok, telegram_ok = asyncio.run(run_network_checks())
+    results["Supabase"] = supabase_ok
+    results["OpenAI"] = openai_ok
+    results["Telegram"] = telegram_ok
     
     print("\n" + "=" * 50)
     print("RESUMEN")
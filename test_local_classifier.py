@@ -0,0 +1,64 @@
+"""
+Script de prueba (sin red) para el clasificador local de gastos de core/brain.py.
+Casos de regresión: lo que debe resolverse localmente y lo que debe escalar al LLM.
+
+Uso: python test_local_classifier.py
+"""
+import os
+import sys
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")  # el cliente no se usa: no hay llamadas a OpenAI
+
+from core.brain import _local_classify_expense
+
+# (mensaje, categoría o acción de consulta esperada; None = escalar al LLM)
+CASES = [
+    # Consultas cortas: solo si el mensaje es exactamente la consulta
+    ("cuánto debo", "check_debt"),
+    ("¿mis deudas?", "check_debt"),
+    ("mi patrimonio", "check_patrimony"),
+    ("cierre de mes", "close_month"),
+    ("deudas y pagué icetex", None),
+    ("cuánto debo y cierre", None),
+    ("patrimonio y gastos", None),
+    ("cerrar", None),
+    # Gastos inequívocos: se clasifican localmente
+    ("gasté 20000 en arriendo", "fixed_survival"),
+    ("arriendo 1.200.000", "fixed_survival"),
+    ("pagué 1.714.300 del arriendo", "fixed_survival"),
+    ("pagué 150 mil de icetex", "fixed_survival"),
+    ("pagué 300k de abono extra a icetex", "debt_offensive"),
+    ("abono icetex 300k", "debt_offensive"),
+    ("gasté 50 mil en aws", "kepler_growth"),
+    # Moneda extranjera, negación o concepto ambiguo: escalar
+    ("pagué 20 dólares de openai", None),
+    ("gasté 100 usd en aws", None),
+    ("no pagué el arriendo 1.200.000", None),
+    ("gasté 50 mil en servicios de uber", None),
+    ("gasté 50000 en el curso de salsa con amigos", None),
+    ("gasté 200k en mercado", None),
+    # Pago EXTRA a deuda fuera del concepto: no puede quedar como fixed_survival
+    ("pagué 300000 extra de icetex", None),
+    ("pagué extra 300000 de icetex", None),
+    ("pagué 300000 abono de icetex", None),
+    ("pagué 300000 como abono extra de lumni", None),
+    ("pagué 200000 adicionales del lumni", None),
+]
+
+
+def main():
+    failures = 0
+    for message, expected in CASES:
+        result = _local_classify_expense(message)
+        got = (result.get("category") or result.get("action")) if result else None
+        if got == expected:
+            print(f"✅ {message!r} -> {got}")
+        else:
+            failures += 1
+            print(f"❌ {message!r} -> {got} (esperado: {expected})")
+    print(f"\n{len(CASES) - failures}/{len(CASES)} casos correctos")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())